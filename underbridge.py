@@ -1,27 +1,201 @@
 # Underbridge OP-Z and OP-XY multichannel exporter
 # Copyright 2022 Thomas Herrmann Email: herrmann@raise-uav.com
 
-import mido
-import pyaudio
+import importlib
+import importlib.util
+import numpy as np
 import wave
-from tkinter import *
-from tkinter import filedialog as fd
-from tkinter import ttk
 import time
 import threading
 import os
+import struct
+import json
+import mmap
+import collections
+import queue
+import shutil
+import subprocess
+import multiprocessing
+import sys
+import argparse
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ProcessPoolExecutor
+
+
+
+class LazyModule:
+    """Imports the module on first use, so the window doesn't wait for the MIDI and audio backends"""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+mido = LazyModule('mido')
+pyaudio = LazyModule('pyaudio')
+
+SETTINGS_PATH = os.path.join(os.path.expanduser('~'), '.underbridge.json')
+settings_lock = threading.Lock()
+
+
+def loadSettings():
+    """Persistent settings like the calibrated start latency, empty if nothing was saved yet"""
+    try:
+        with open(SETTINGS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveSettings(settings):
+    try:
+        with open(SETTINGS_PATH, 'w') as f:
+            json.dump(settings, f, indent=2)
+    except OSError as e:
+        print("Could not save settings:", e)
+
+
+def updateSettings(section, key, value):
+    """Set settings[section][key] and save. Re-reads the file so what other exports saved meanwhile is kept"""
+    with settings_lock:
+        settings = loadSettings()
+        settings.setdefault(section, {})[key] = value
+        saveSettings(settings)
+    return settings
+
+
+def levelsDbfs(data):
+    """Peak and RMS level in dBFS of 16 bit audio (bytes or an int16 array), -inf for digital silence"""
+    if not isinstance(data, np.ndarray):
+        data = np.frombuffer(data, dtype='<i2')
+    samples = data.astype(np.float32) / 32768.0
+    if samples.size == 0:
+        return float('-inf'), float('-inf')
+    with np.errstate(divide='ignore'):
+        peak = 20 * np.log10(np.max(np.abs(samples)))
+        rms = 10 * np.log10(np.mean(np.square(samples)))
+    return float(peak), float(rms)
+
+
+class PerfStats:
+    """Timers, counters and per-take figures of one export, thread safe. Written as JSON report at the end"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timers = {}  # name -> [count, total seconds, max seconds]
+        self.counters = collections.Counter()
+        self.takes = []
+        self.checks = []
+        self.info = {}
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def timer(self, name):
+        """with stats.timer('stream_open'): ..."""
+        return _StatsTimer(self, name)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_take(self, take):
+        with self.lock:
+            self.takes.append(take)
+
+    def add_check(self, check):
+        with self.lock:
+            self.checks.append(check)
+
+    def summary(self):
+        """A few lines for the live view"""
+        with self.lock:
+            lines = ["Takes: {}  xruns: {}  written: {:.1f} MB  running: {:.0f} s".format(
+                len(self.takes), sum(take['xruns'] for take in self.takes),
+                self.counters['bytes_written'] / 1e6, time.time() - self.started)]
+            if self.takes:
+                take = self.takes[-1]
+                lines.append("Last take {}: MIDI send {:.2f} ms, late {:.1f} ms, jitter {:.2f} ms, xruns {}".format(
+                    take['label'], take['midi_send_ms'], take['late_ms'], take['jitter_ms'], take['xruns']))
+            for name, (count, total, longest) in sorted(self.timers.items()):
+                lines.append("{}: {} x, mean {:.2f} ms, max {:.2f} ms".format(name, count, total / count * 1000, longest * 1000))
+        return "\n".join(lines)
+
+    def report(self):
+        with self.lock:
+            return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                    'wall_s': round(time.time() - self.started, 3),
+                    'info': dict(self.info),
+                    'timers': {name: {'count': count, 'total_ms': round(total * 1000, 3),
+                                      'mean_ms': round(total / count * 1000, 3), 'max_ms': round(longest * 1000, 3)}
+                               for name, (count, total, longest) in self.timers.items()},
+                    'counters': dict(self.counters),
+                    'takes': list(self.takes),
+                    'checks': list(self.checks)}
+
+    def write(self, path):
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+        except OSError as e:
+            print("Could not write report:", e)
+
+
+class _StatsTimer:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.perf_counter() - self.t0)
 
 
 # Device abstraction layer for OP-Z and OP-XY
 class DeviceInterface:
     """Base class for device-specific MIDI implementations"""
+
+    # Settling times in seconds. The sequencer moves on as soon as MIDI feedback or
+    # silence on the input says the device is ready, these are the upper bounds.
+    mute_settle = 0.1        # after a burst of mute CCs
+    stop_timeout = 2.0       # for the audio to go quiet after stop
+    pattern_timeout = 5.0    # for the device to go idle before switching patterns
+    pattern_settle = 0.5     # after the next pattern CC
+    silence_threshold = -60  # dBFS below which the input counts as silent
+    silence_hold = 0.1       # seconds the input has to stay below the threshold
+    mute_channels = 14       # 8 tracks and 6 modifier tracks
     
     def __init__(self, outport):
         self.outport = outport
+        self.mute_state = [None] * self.mute_channels  # last value sent per channel, None until the first send
     
+    def mute_message(self, channel, mute_value):
+        """MIDI message that mutes/unmutes a specific channel"""
+        raise NotImplementedError
+
     def mute_channel(self, channel, mute_value):
         """Mute/unmute a specific channel"""
-        raise NotImplementedError
+        self.outport.send(self.mute_message(channel, mute_value))
+        self.mute_state[channel] = mute_value
+
+    def set_mutes(self, mute_list):
+        """Bring all channels to mute_list in one burst, sending only the ones that change. Returns those channels"""
+        changed = [channel for channel, value in enumerate(mute_list) if self.mute_state[channel] != value]
+        for channel in changed:
+            self.mute_channel(channel, mute_list[channel])
+        return changed
     
     def start_playback(self):
         """Start MIDI playback"""
@@ -39,86 +213,2369 @@ class DeviceInterface:
         """Return device name for identification"""
         raise NotImplementedError
 
+    def return_to_start(self):
+        """Stop and move the song position back to the first step of the chain"""
+        self.outport.send(mido.Message('stop'))
+        self.outport.send(mido.Message('songpos', pos=0))
+
+
+class OPZDevice(DeviceInterface):
+    """OP-Z specific MIDI implementation"""
+    
+    def get_device_name(self):
+        return "OP-Z"
+    
+    def mute_message(self, channel, mute_value):
+        """OP-Z uses CC 53 for mute control"""
+        return mido.Message('control_change', control=53, channel=channel, value=mute_value)
+    
+    def start_playback(self):
+        """Standard MIDI start message"""
+        msg = mido.Message('start')
+        self.outport.send(msg)
+    
+    def stop_playback(self):
+        """Standard MIDI stop message"""
+        msg = mido.Message('stop')
+        self.outport.send(msg)
+    
+    def next_pattern(self):
+        """OP-Z uses CC 103 value 16 for next pattern"""
+        msg = mido.Message('control_change', control=103, value=16)
+        self.outport.send(msg)
+
+
+class OPXYDevice(DeviceInterface):
+    """OP-XY specific MIDI implementation"""
+    
+    def get_device_name(self):
+        return "OP-XY"
+    
+    def mute_message(self, channel, mute_value):
+        """OP-XY uses CC 53 for mute control (same as OP-Z)"""
+        return mido.Message('control_change', control=53, channel=channel, value=mute_value)
+    
+    def start_playback(self):
+        """Standard MIDI start message"""
+        msg = mido.Message('start')
+        self.outport.send(msg)
+    
+    def stop_playback(self):
+        """Standard MIDI stop message"""
+        msg = mido.Message('stop')
+        self.outport.send(msg)
+    
+    def next_pattern(self):
+        """OP-XY uses CC 103 for pattern navigation (similar to OP-Z)"""
+        msg = mido.Message('control_change', control=103, value=16)
+        self.outport.send(msg)
+
+
+class StreamingWavWriter:
+    """WAV sink that appends audio blocks as they arrive and keeps the header valid on disk"""
+
+    HEADER_SIZE = 44
+
+    def __init__(self, filename, channels, sampwidth, rate, sync_interval=1.0):
+        self.filename = filename
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.rate = rate
+        self.frame_size = channels * sampwidth
+        self.data_bytes = 0
+        # Header sizes are patched after roughly this many bytes so a crash keeps the take
+        self.sync_bytes = max(int(rate * self.frame_size * sync_interval), self.frame_size)
+        self.unsynced_bytes = 0
+        self.file = open(filename, 'wb')
+        self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_header(self):
+        """Write the RIFF header for the data written so far and return to the end of the file"""
+        self.file.seek(0)
+        self.file.write(struct.pack('<4sI4s4sIHHIIHH4sI',
+                                    b'RIFF', 36 + self.data_bytes + (self.data_bytes & 1), b'WAVE',
+                                    b'fmt ', 16, 1, self.channels, self.rate,
+                                    self.rate * self.frame_size, self.frame_size, self.sampwidth * 8,
+                                    b'data', self.data_bytes))
+        self.file.seek(0, os.SEEK_END)
+
+    def write(self, data):
+        """Append a block of interleaved frames, as bytes or a (frames, channels) int16 array"""
+        if isinstance(data, np.ndarray):
+            # Deinterleaved channel views are strided, this is the one copy on the way to disk
+            data = np.ascontiguousarray(data)
+        size = memoryview(data).nbytes
+        self.file.write(data)
+        self.data_bytes += size
+        self.unsynced_bytes += size
+        if self.unsynced_bytes >= self.sync_bytes:
+            self.sync()
+
+    def sync(self):
+        """Patch the header sizes and flush everything written so far to the OS"""
+        self.write_header()
+        self.file.flush()
+        self.unsynced_bytes = 0
+
+    def frames_written(self):
+        return self.data_bytes // self.frame_size
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.data_bytes & 1:
+            self.file.write(b'\x00')  # RIFF chunks are word aligned
+        self.write_header()
+        self.file.close()
+
+
+class MappedWavWriter:
+    """WAV sink for takes of known length. The file is preallocated and blocks are copied straight into a memory map.
+
+    A JUNK chunk the size of a ds64 chunk follows the RIFF header, so a take that grows past 4 GB turns into RF64
+    in place. close() cuts the file to the length actually recorded.
+    """
+
+    HEADER_SIZE = 80
+    RIFF_LIMIT = 0xFFFFFFFF
+
+    def __init__(self, filename, channels, sampwidth, rate, n_frames, sync_interval=1.0):
+        self.filename = filename
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.rate = rate
+        self.frame_size = channels * sampwidth
+        self.data_bytes = 0
+        self.sync_bytes = max(int(rate * self.frame_size * sync_interval), self.frame_size)
+        self.unsynced_bytes = 0
+        self.file = open(filename, 'w+b')
+        self.map = None
+        self.allocate(self.HEADER_SIZE + max(n_frames, 1) * self.frame_size)
+        self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def allocate(self, size):
+        """Resize the file to size bytes and map all of it"""
+        if self.map:
+            self.map.close()
+        self.file.truncate(size)
+        if hasattr(os, 'posix_fallocate'):
+            # Reserve the blocks now, a full disk would otherwise crash the writer through the map
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def write_header(self):
+        data_bytes = self.data_bytes + (self.data_bytes & 1)
+        riff_bytes = self.HEADER_SIZE - 8 + data_bytes
+        if riff_bytes > self.RIFF_LIMIT:
+            # The 32 bit sizes say "see ds64"
+            riff = (b'RF64', 0xFFFFFFFF)
+            ds64 = (b'ds64', 28, struct.pack('<QQQI', riff_bytes, self.data_bytes, self.frames_written(), 0))
+            data_size = 0xFFFFFFFF
+        else:
+            riff = (b'RIFF', riff_bytes)
+            ds64 = (b'JUNK', 28, bytes(28))
+            data_size = self.data_bytes
+        self.map[:self.HEADER_SIZE] = struct.pack('<4sI4s4sI28s4sIHHIIHH4sI',
+                                                  riff[0], riff[1], b'WAVE', *ds64,
+                                                  b'fmt ', 16, 1, self.channels, self.rate,
+                                                  self.rate * self.frame_size, self.frame_size, self.sampwidth * 8,
+                                                  b'data', data_size)
+
+    def write(self, data):
+        """Copy a block of interleaved frames, as bytes or a (frames, channels) int16 array, into the map"""
+        if isinstance(data, np.ndarray):
+            size = data.shape[0] * self.frame_size
+        else:
+            size = memoryview(data).nbytes
+        start = self.HEADER_SIZE + self.data_bytes
+        end = start + size
+        if end > len(self.map):
+            # Longer than announced, grow by half again
+            self.allocate(max(end, len(self.map) + len(self.map) // 2))
+        if isinstance(data, np.ndarray):
+            # Strided channel views are gathered right into the mapped file
+            target = np.frombuffer(self.map, dtype=data.dtype, count=data.size, offset=start)
+            target.reshape(data.shape)[...] = data
+            del target
+        else:
+            self.map[start:end] = data
+        self.data_bytes += size
+        self.unsynced_bytes += size
+        if self.unsynced_bytes >= self.sync_bytes:
+            self.sync()
+
+    def sync(self):
+        """Patch the header sizes, the data is in the page cache already"""
+        self.write_header()
+        self.unsynced_bytes = 0
+
+    def frames_written(self):
+        return self.data_bytes // self.frame_size
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.write_header()
+        self.map.close()
+        self.map = None
+        # Word aligned, the pad byte is the zero that was preallocated
+        self.file.truncate(self.HEADER_SIZE + self.data_bytes + (self.data_bytes & 1))
+        self.file.close()
+
+
+class BufferSink:
+    """In-memory sink for short takes that are analysed instead of saved"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        pass
+
+
+class SplitSink:
+    """Cuts one continuous take into consecutive sinks at fixed frame lengths"""
+
+    def __init__(self, sinks, lengths, frame_size):
+        self.sinks = sinks
+        self.lengths = lengths  # frames per sink, the last one takes whatever is left
+        self.frame_size = frame_size
+        self.index = 0
+        self.written = 0
+
+    def write(self, data):
+        if isinstance(data, np.ndarray):
+            frames = data.shape[0]
+            view = data
+        else:
+            view = memoryview(data).cast('B')
+            frames = len(view) // self.frame_size
+        first = 0
+        while first < frames:
+            if self.index < len(self.sinks) - 1:
+                last = min(frames, first + self.lengths[self.index] - self.written)
+            else:
+                last = frames
+            if isinstance(view, np.ndarray):
+                self.sinks[self.index].write(view[first:last])
+            else:
+                self.sinks[self.index].write(view[first * self.frame_size:last * self.frame_size])
+            self.written += last - first
+            first = last
+            if first < frames:
+                self.index += 1
+                self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class ChannelSplitSink:
+    """Deinterleaves a multichannel take into stereo sinks, one per channel pair"""
+
+    def __init__(self, routes, channels):
+        self.routes = routes  # [(first input channel, sink)]
+        self.channels = channels
+
+    def write(self, data):
+        block = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels)
+        for first, sink in self.routes:
+            sink.write(block[:, first:first + 2])  # a view, nothing is copied here
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for first, sink in self.routes:
+            sink.close()
+
+
+def parseChannelMap(text):
+    """ "1:1,2:3" -> [[1, 1], [2, 3]], track 1 on inputs 1-2 and track 2 on inputs 3-4"""
+    channel_map = []
+    for entry in text.replace(' ', '').split(','):
+        if not entry:
+            continue
+        try:
+            track, channel = entry.split(':')
+            channel_map.append([int(track), int(channel)])
+        except ValueError:
+            raise ValueError("channel map entry {!r} should be track:first input, e.g. 1:1,2:3".format(entry))
+    return channel_map
+
+
+class RingBuffer:
+    """Preallocated byte ring filled by the audio callback and drained by the writer thread"""
+
+    def __init__(self, size, frame_size):
+        self.frame_size = frame_size
+        self.size = max(size - size % frame_size, frame_size)
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        # Monotonic byte counters of the stream, write_count only moves in the callback, read_count only in the reader
+        self.write_count = 0
+        self.read_count = 0
+        # A dropped block keeps its place in the stream and is read back as silence, so later frames stay in sync
+        self.dropped = 0  # bytes of dropped blocks, write_count - dropped went into the ring
+        self.consumed = 0  # bytes the reader took out of the ring
+        self.held = 0  # bytes of the view the last read returned, handed back to the callback on the next read
+        self.gaps = collections.deque()  # (stream byte position, length) of dropped blocks not read yet
+        self.overflows = 0
+        self.underflows = 0
+        self.data_ready = threading.Condition()
+
+    def write(self, data):
+        """Copy a block into the ring, never blocks. Returns False if the block had to be dropped, it reads back as silence"""
+        n = len(data)
+        stored = self.write_count - self.dropped
+        if stored - self.consumed + n > self.size:
+            self.overflows += 1
+            with self.data_ready:
+                self.gaps.append((self.write_count, n))
+                self.dropped += n
+                self.write_count += n
+                self.data_ready.notify()
+            return False
+        pos = stored % self.size
+        first = min(n, self.size - pos)
+        src = memoryview(data)
+        self.view[pos:pos + first] = src[:first]
+        if first < n:
+            self.view[:n - first] = src[first:]
+        with self.data_ready:
+            self.write_count += n
+            self.data_ready.notify()
+        return True
+
+    def read(self, max_bytes, timeout=0.1):
+        """Up to max_bytes of whole frames as a view into the ring, or b'' if nothing arrived before the timeout.
+
+        Nothing is copied, the view stays valid until the next read. A read stops at the end of the ring,
+        the next one continues from its start.
+        """
+        self.consumed += self.held
+        self.held = 0
+        with self.data_ready:
+            if self.write_count == self.read_count:
+                self.data_ready.wait(timeout)
+            available = self.write_count - self.read_count
+            gap = self.gaps[0] if self.gaps else None
+        if available == 0:
+            self.underflows += 1
+            return b''
+        if gap and gap[0] == self.read_count:
+            self.gaps.popleft()
+            self.read_count += gap[1]
+            return bytes(gap[1])
+        n = min(available, max_bytes - max_bytes % self.frame_size)
+        if gap:
+            n = min(n, gap[0] - self.read_count)
+        pos = self.consumed % self.size
+        n = min(n, self.size - pos)
+        self.held = n
+        self.read_count += n
+        return self.view[pos:pos + n]
+
+
+class Take:
+    """A window of the running input stream [start, end) in absolute stream frames, written to sink"""
+
+    def __init__(self, sink, n_frames, start=None, tail=None):
+        self.sink = sink
+        self.n_frames = n_frames
+        self.tail = tail  # optional TailDetector that can end the take before n_frames
+        self.meter = None  # optional LevelMeter fed with the take's blocks
+        self.start = None
+        self.end = None
+        self.sent_at = None  # stream time of the MIDI start
+        self.stats = {}  # filled in by CaptureEngine.record
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.armed = threading.Event()
+        self.done = threading.Event()
+        self.aborted = False
+        if start is not None:
+            self.arm(start)
+
+    def arm(self, start):
+        """Fix the first frame of the take, the writer holds back until this is known"""
+        self.start = start
+        self.end = start + self.n_frames
+        self.armed.set()
+
+
+class TailDetector:
+    """Ends a take once the windowed level stayed below a threshold for a hold time after a minimum length"""
+
+    def __init__(self, min_frames, hold_frames, threshold_dbfs, channels, window_frames=480):
+        self.min_frames = min_frames
+        self.hold_frames = hold_frames
+        self.threshold_power = (32768.0 * 10 ** (threshold_dbfs / 20.0)) ** 2
+        self.channels = channels
+        self.window_frames = window_frames
+        self.last_loud = 0  # take frame right after the last window above the threshold
+
+    def update(self, data, offset):
+        """Feed the block starting at take frame offset. Returns the take length once the tail has decayed"""
+        samples = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels).astype(np.float32)
+        n = samples.shape[0]
+        if n == 0:
+            return None
+        starts = np.arange(0, n, self.window_frames)
+        frame_power = np.square(samples).mean(axis=1)
+        power = np.add.reduceat(frame_power, starts) / np.diff(np.append(starts, n))
+        loud = np.flatnonzero(power > self.threshold_power)
+        if loud.size:
+            self.last_loud = offset + min(starts[loud[-1]] + self.window_frames, n)
+        end = max(self.min_frames, self.last_loud + self.hold_frames)
+        if end <= offset + n:
+            return end
+        return None
+
+
+class LevelMeter:
+    """Peak and RMS per input channel over a take, computed on every decimation-th frame to stay cheap"""
+
+    def __init__(self, channels, callback, decimation=8, interval=0.05):
+        self.channels = channels
+        self.callback = callback  # gets levels() at most every interval seconds
+        self.decimation = decimation
+        self.interval = interval
+        self.peak = np.zeros(channels, dtype=np.int32)
+        self.power = np.zeros(channels)
+        self.count = 0
+        self.reported = 0.0
+
+    def update(self, data):
+        samples = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels)[::self.decimation]
+        if samples.shape[0] == 0:
+            return
+        wide = samples.astype(np.int32)
+        self.peak = np.maximum(self.peak, np.abs(wide).max(axis=0))
+        self.power = self.power + np.square(wide, dtype=np.float64).sum(axis=0)
+        self.count += samples.shape[0]
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.callback(self.levels())
+
+    def levels(self):
+        """[(peak dBFS, RMS dBFS)] per channel, -inf for silence"""
+        with np.errstate(divide='ignore'):
+            peak = 20 * np.log10(self.peak / 32768.0)
+            rms = 10 * np.log10(self.power / max(self.count, 1) / 32768.0 ** 2)
+        return [(float(p), float(r)) for p, r in zip(peak, rms)]
+
+
+class CaptureEngine:
+    """PyAudio callback capture. The callback only copies into a ring buffer, a writer thread drains it"""
+
+    def __init__(self, pa, device_index, rate, channels=2, sample_format=None,
+                 frames_per_buffer=128, buffer_seconds=2.0, stats=None):
+        if sample_format is None:
+            sample_format = pyaudio.paInt16
+        self.pa = pa
+        self.stats = stats  # optional PerfStats
+        self.device_index = device_index
+        self.rate = rate
+        self.channels = channels
+        self.sample_format = sample_format
+        self.sampwidth = pa.get_sample_size(sample_format)
+        self.frame_size = channels * self.sampwidth
+        self.frames_per_buffer = frames_per_buffer
+        # The ring has to hold at least a few callback blocks or every block would be dropped
+        ring_frames = max(int(rate * buffer_seconds), frames_per_buffer * 4)
+        self.ring = RingBuffer(ring_frames * self.frame_size, self.frame_size)
+        self.stream = None
+        self.writer_thread = None
+        self.running = False
+        self.take = None
+        self.input_latency = 0.0
+        self.clock = None  # (stream frame, ADC time) of the newest block, maps stream time to frames
+        self.start_offset = 0.0  # calibrated delay between MIDI start and the downbeat in the audio
+        self.silence_level = 32  # peak sample value counted as silence
+        self.last_loud_frame = 0  # stream frame of the last block above silence_level
+        self.level_changed = threading.Condition()
+        self.input_overflows = 0    # reported by PortAudio
+        self.input_underflows = 0   # reported by PortAudio
+        self.block_jitter = 0.0     # largest deviation of a block's ADC time from where the previous block ended
+        self.callback_max = 0.0     # longest callback in seconds
+        self.audio_timeout = 2.0    # seconds without a block before a take gives up
+
+    @property
+    def overflow_count(self):
+        return self.ring.overflows + self.input_overflows
+
+    @property
+    def underflow_count(self):
+        return self.ring.underflows + self.input_underflows
+
+    @property
+    def captured_frames(self):
+        """Absolute stream position of the newest frame handed over by the callback"""
+        return self.ring.write_count // self.frame_size
+
+    def callback(self, in_data, frame_count, time_info, status_flags):
+        """Runs on the PortAudio thread, so nothing in here may block"""
+        t0 = time.perf_counter()
+        if status_flags & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        if status_flags & pyaudio.paInputUnderflow:
+            self.input_underflows += 1
+        frame = self.ring.write_count // self.frame_size
+        if self.ring.write(in_data):
+            adc_time = time_info.get('input_buffer_adc_time', 0) if time_info else 0
+            if not adc_time and time_info:
+                # Some host APIs leave the ADC time at 0, estimate it from the callback time
+                adc_time = time_info.get('current_time', 0) - self.input_latency - frame_count / self.rate
+            clock = self.clock
+            if clock is not None and clock[1]:
+                expected = clock[1] + (frame - clock[0]) / self.rate
+                self.block_jitter = max(self.block_jitter, abs(adc_time - expected))
+            self.clock = (frame, adc_time)
+        self.callback_max = max(self.callback_max, time.perf_counter() - t0)
+        return (None, pyaudio.paContinue)
+
+    def wait_clock(self, timeout):
+        """Block until the callback has timed a block, the stream clock is needed to place a take"""
+        deadline = time.monotonic() + timeout
+        while self.clock is None:
+            if time.monotonic() > deadline or not self.running:
+                raise IOError("No audio from the device for {} s".format(timeout))
+            time.sleep(0.001)
+
+    def frame_at(self, stream_time):
+        """Absolute stream frame that was captured at stream_time"""
+        clock = self.clock
+        if clock is None:
+            raise IOError("Stream clock not known before the first audio block")
+        frame, adc_time = clock
+        return frame + int(round((stream_time - adc_time) * self.rate))
+
+    def writer(self):
+        """Drain the ring for as long as the stream runs, writing whatever overlaps the armed take"""
+        block_bytes = self.frames_per_buffer * self.frame_size * 16
+        while self.running:
+            position = self.ring.read_count // self.frame_size
+            data = self.ring.read(block_bytes)  # a view into the ring, sinks copy it once into their file
+            if data:
+                t0 = time.perf_counter()
+                self.track_level(data, position)
+                if self.stats:
+                    # Processing per block read, the wait for data isn't counted
+                    self.stats.add_time('block_level', time.perf_counter() - t0)
+            take = self.take
+            if not data or take is None:
+                continue
+            # Hold the block until the take knows where its downbeat is
+            while not take.armed.wait(0.01):
+                if not self.running:
+                    return
+            if take.done.is_set():
+                continue
+            end = position + len(data) // self.frame_size
+            first = max(position, take.start)
+            last = min(end, take.end)
+            if last > first and take.tail:
+                fs = self.frame_size
+                length = take.tail.update(data[(first - position) * fs:(last - position) * fs], first - take.start)
+                if length is not None:
+                    take.end = min(take.end, take.start + length)
+                    last = min(last, take.end)
+            if last > first:
+                t0 = time.perf_counter()
+                block = data[(first - position) * self.frame_size:(last - position) * self.frame_size]
+                take.sink.write(block)
+                elapsed = time.perf_counter() - t0
+                if take.meter:
+                    take.meter.update(block)
+                take.write_time += elapsed
+                take.bytes_written += (last - first) * self.frame_size
+                if self.stats:
+                    self.stats.add_time('file_write', elapsed)
+                    self.stats.count('bytes_written', (last - first) * self.frame_size)
+            if end >= take.end:
+                take.done.set()
+
+    def track_level(self, data, position):
+        """Remember the last loud block so the sequencer can wait for silence instead of sleeping"""
+        if np.abs(np.frombuffer(data, dtype='<i2')).max() > self.silence_level:
+            with self.level_changed:
+                self.last_loud_frame = position + len(data) // self.frame_size
+                self.level_changed.notify_all()
+
+    def set_silence_threshold(self, dbfs):
+        self.silence_level = int(32767 * 10 ** (dbfs / 20.0))
+
+    def wait_silence(self, hold, timeout):
+        """Block until the input stayed silent for hold seconds. Returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        hold_frames = int(hold * self.rate)
+        while self.ring.read_count // self.frame_size - self.last_loud_frame < hold_frames:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.running:
+                return False
+            with self.level_changed:
+                self.level_changed.wait(min(remaining, hold))
+        return True
+
+    def start(self):
+        """Open the input stream once, it keeps running until stop()"""
+        self.running = True
+        self.stream = self.pa.open(format=self.sample_format,
+                                   channels=self.channels,
+                                   rate=self.rate,
+                                   input=True,
+                                   input_device_index=self.device_index,
+                                   frames_per_buffer=self.frames_per_buffer,
+                                   stream_callback=self.callback)
+        self.input_latency = self.stream.get_input_latency()
+        self.writer_thread = threading.Thread(target=self.writer, daemon=True)
+        self.writer_thread.start()
+
+    def stop(self):
+        self.abort_take()
+        self.running = False
+        stream, self.stream = self.stream, None
+        try:
+            if stream:
+                stream.stop_stream()
+                stream.close()
+        finally:
+            if self.writer_thread:
+                self.writer_thread.join()
+                self.writer_thread = None
+
+    def abort_take(self):
+        take = self.take
+        if take:
+            take.aborted = True
+            take.done.set()
+            take.armed.set()
+
+    def record(self, sink, n_frames, on_start=None, tail=None, meter=None):
+        """Cut n_frames into sink, starting at the downbeat triggered by on_start (the MIDI start).
+
+        The send time of on_start is taken on the stream clock, so sample 0 of every take is the
+        downbeat plus the calibrated start_offset, no matter when the call lands between two blocks.
+        With a TailDetector the take ends early once the tail has decayed, n_frames is the hard cap.
+        """
+        take = Take(sink, n_frames, tail=tail)
+        take.meter = meter
+        self.take = take
+        t0 = time.perf_counter()
+        overflows = self.overflow_count
+        self.block_jitter = 0.0
+        send_time = 0.0
+        try:
+            if on_start:
+                # A MIDI start sent before the first block couldn't be placed on the stream clock
+                self.wait_clock(self.audio_timeout)
+                before = self.stream.get_time()
+                on_start()
+                after = self.stream.get_time()
+                send_time = after - before
+                take.sent_at = (before + after) / 2
+                start = self.frame_at(take.sent_at) + int(round(self.start_offset * self.rate))
+            else:
+                start = self.captured_frames
+            # Frames the writer already passed can't be recorded anymore
+            passed = self.ring.read_count // self.frame_size
+            take.arm(max(start, passed))
+            if n_frames == 0:
+                take.done.set()
+            captured = self.captured_frames
+            last_block = time.monotonic()
+            while not take.done.wait(0.5):
+                if not self.stream.is_active():
+                    raise IOError("Audio stream stopped unexpectedly")
+                if self.captured_frames != captured:
+                    captured = self.captured_frames
+                    last_block = time.monotonic()
+                elif time.monotonic() - last_block > self.audio_timeout:
+                    raise IOError("No audio from the device for {} s".format(self.audio_timeout))
+        finally:
+            self.take = None
+        take.stats = {'frames': take.bytes_written // self.frame_size,  # captured, short if the take was aborted
+                      'midi_send_ms': round(send_time * 1000, 3),
+                      'late_ms': round(max(passed - start, 0) / self.rate * 1000, 3),  # start the take missed
+                      'jitter_ms': round(self.block_jitter * 1000, 3),
+                      'xruns': self.overflow_count - overflows,
+                      'bytes_written': take.bytes_written,
+                      'write_ms': round(take.write_time * 1000, 3),
+                      'wall_s': round(time.perf_counter() - t0, 3)}
+        return take
+
+
+class MidiListener:
+    """Watches the device's MIDI output for clock, transport and echoed messages"""
+
+    def __init__(self, port_name):
+        self.port_name = port_name
+        self.port = None
+        self.received = 0  # running message count, lets waiters ignore what came before them
+        self.messages = collections.deque(maxlen=64)
+        self.last_clock = None
+        self.clock_times = collections.deque(maxlen=97)  # 4 beats of 24 ppq clock
+        self.ticks = 0  # clocks since the last start
+        self.loop_ticks = None  # clocks from start until the song position first jumped back
+        self.playing = False
+        self.song_position = None
+        self.changed = threading.Condition()
+
+    def open(self):
+        self.port = mido.open_input(self.port_name, callback=self.receive)
+
+    def close(self):
+        if self.port:
+            self.port.close()
+            self.port = None
+
+    def receive(self, msg):
+        """Called on the MIDI input thread for every incoming message"""
+        with self.changed:
+            if msg.type == 'clock':
+                self.last_clock = time.monotonic()
+                self.clock_times.append(self.last_clock)
+                self.ticks += 1
+            else:
+                if msg.type == 'start':
+                    self.mark_start()
+                if msg.type in ('start', 'continue'):
+                    self.playing = True
+                elif msg.type == 'stop':
+                    self.playing = False
+                elif msg.type == 'songpos':
+                    # Song position counts 16th notes, 6 clocks each. A jump back while playing is the loop point
+                    if self.playing and self.loop_ticks is None and msg.pos * 6 < self.ticks - 6:
+                        self.loop_ticks = self.ticks - msg.pos * 6
+                    self.song_position = msg.pos
+                self.received += 1
+                self.messages.append((self.received, msg))
+            self.changed.notify_all()
+
+    def wait_for(self, predicate, since, timeout):
+        """Wait for a message newer than the count since that matches predicate"""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                if any(nr > since and predicate(msg) for nr, msg in self.messages):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+
+    def mark_start(self):
+        """Restart clock counting, called for our own start too in case the device doesn't echo it"""
+        with self.changed:
+            self.ticks = 0
+            self.loop_ticks = None
+            self.clock_times.clear()
+            self.playing = True
+
+    def wait_loop(self, timeout):
+        """Wait until the loop point of the playing pattern is known"""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.loop_ticks is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def wait_ticks(self, ticks, timeout):
+        """Wait until at least ticks clocks arrived since the last start"""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.ticks < ticks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def bpm(self):
+        """Tempo from the median 24 ppq clock interval, None until a full beat was received"""
+        times = list(self.clock_times)
+        if len(times) < 25:
+            return None
+        interval = float(np.median(np.diff(times)))
+        return 60.0 / (interval * 24) if interval > 0 else None
+
+    def pattern_bars(self):
+        """Pattern length in 4/4 bars if the device reported its loop point, else None"""
+        if self.loop_ticks is None:
+            return None
+        return self.loop_ticks / 96.0
+
+    def clock_running(self, quiet=0.1):
+        return self.last_clock is not None and time.monotonic() - self.last_clock < quiet
+
+    def wait_clock_stopped(self, timeout, quiet=0.1):
+        deadline = time.monotonic() + timeout
+        while self.clock_running(quiet):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(quiet / 4)
+        return True
+
+
+class AudioMidiSession:
+    """One PortAudio instance, one running input stream and one MIDI port shared by every take of an export"""
+
+    def __init__(self, midi_port_name, device_type, audio_device, rate, channels=2,
+                 frames_per_buffer=128, buffer_seconds=2.0, midi_input_name=None, stats=None):
+        self.midi_port_name = midi_port_name
+        self.stats = stats or PerfStats()
+        self.midi_input_name = midi_input_name
+        self.device_type = device_type
+        self.audio_device = audio_device
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.buffer_seconds = buffer_seconds
+        self.pa = None
+        self.engine = None
+        self.outport = None
+        self.device = None
+        self.listener = None
+
+    def open(self):
+        with self.stats.timer('midi_open'):
+            self.outport = mido.open_output(self.midi_port_name)
+        # Initialize device interface based on detected device type
+        if self.device_type == "OP-XY":
+            self.device = OPXYDevice(self.outport)
+        else:
+            # Default to OP-Z for backward compatibility
+            self.device = OPZDevice(self.outport)
+        print(f"Initialized device interface: {self.device.get_device_name()}")
+        if self.midi_input_name:
+            try:
+                self.listener = MidiListener(self.midi_input_name)
+                self.listener.open()
+            except Exception as e:
+                # Feedback is optional, the sequencer falls back to silence detection and timeouts
+                print("MIDI input not available:", e)
+                self.listener = None
+        with self.stats.timer('stream_open'):
+            self.pa = pyaudio.PyAudio()
+            self.engine = CaptureEngine(self.pa, self.audio_device, self.rate, self.channels,
+                                        frames_per_buffer=self.frames_per_buffer,
+                                        buffer_seconds=self.buffer_seconds, stats=self.stats)
+            self.engine.set_silence_threshold(self.device.silence_threshold)
+            self.engine.start()
+        self.stats.info.update({'rate': self.rate, 'channels': self.channels,
+                                'frames_per_buffer': self.frames_per_buffer,
+                                'input_latency_ms': round(self.engine.input_latency * 1000, 3)})
+
+    def wait_idle(self, timeout):
+        """Wait until the device stopped sending clock and the input went silent"""
+        deadline = time.monotonic() + timeout
+        if self.listener:
+            self.listener.wait_clock_stopped(timeout)
+        return self.engine.wait_silence(self.device.silence_hold, max(deadline - time.monotonic(), 0))
+
+    def wait_feedback(self, predicate, since, timeout):
+        """Wait for the device to echo a message, or the full timeout if it has no MIDI output"""
+        if self.listener:
+            return self.listener.wait_for(predicate, since, timeout)
+        time.sleep(timeout)
+        return False
+
+    def feedback_mark(self):
+        return self.listener.received if self.listener else 0
+
+    def set_start_offset(self, seconds):
+        self.engine.start_offset = seconds
+
+    def close(self):
+        """Release everything, also when the device is already gone and some of it fails"""
+        engine, self.engine = self.engine, None
+        pa, self.pa = self.pa, None
+        listener, self.listener = self.listener, None
+        outport, self.outport = self.outport, None
+        if engine:
+            self.stats.info.update({'overflows': engine.overflow_count, 'underflows': engine.underflow_count,
+                                    'callback_max_ms': round(engine.callback_max * 1000, 3)})
+        for release in (engine and engine.stop, pa and pa.terminate, listener and listener.close,
+                        outport and outport.close):
+            if release:
+                try:
+                    release()
+                except Exception as e:
+                    print("Error while closing:", repr(e))
+
+
+class ConnectionSupervisor:
+    """Watches the MIDI port and the audio stream of a session and aborts the running take when the unit is gone"""
+
+    def __init__(self, session, interval=1.0, stall_timeout=2.0):
+        self.session = session
+        self.interval = interval
+        self.stall_timeout = stall_timeout  # seconds without new audio frames before the unit counts as gone
+        self.lost = threading.Event()
+        self.reason = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.captured = None
+        self.captured_at = time.monotonic()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.check():
+                return
+
+    def check(self):
+        """True if the unit is gone, then the take in progress is aborted so the sequencer can react"""
+        with self.lock:
+            if self.lost.is_set():
+                return True
+            engine = self.session.engine
+            now = time.monotonic()
+            if engine.captured_frames != self.captured:
+                self.captured = engine.captured_frames
+                self.captured_at = now
+            reason = None
+            try:
+                if self.session.midi_port_name not in mido.get_output_names():
+                    reason = "MIDI port {} disappeared".format(self.session.midi_port_name)
+                elif not engine.stream or not engine.stream.is_active():
+                    reason = "audio stream stopped"
+                elif now - self.captured_at > self.stall_timeout:
+                    reason = "no audio from the device"
+            except Exception as e:
+                reason = "device check failed: {}".format(e)
+            if reason is None:
+                return False
+            print("Connection lost:", reason)
+            self.reason = reason
+            self.lost.set()
+        engine.abort_take()
+        return True
+
+
+class ExportCheckpoint:
+    """Progress of an export in projectpath, written after every finished take so a failed export can resume"""
+
+    FILENAME = 'underbridge_checkpoint.json'
+
+    def __init__(self, projectpath, job):
+        self.path = os.path.join(projectpath, self.FILENAME)
+        self.projectpath = projectpath
+        self.job = job  # name, mode and pattern count, a checkpoint of another job is not resumed
+        self.done = {}  # "pattern/track+track" -> {relative stem path: frames}
+
+    @staticmethod
+    def key(pattern, tracks):
+        return "{}/{}".format('all' if pattern is None else pattern, '+'.join(str(track) for track in tracks))
+
+    def load(self):
+        """Read the stored progress. Returns False if there is none for this job"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('job') != self.job:
+            return False
+        self.done = data.get('done', {})
+        return True
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'job': self.job, 'done': self.done}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def mark_done(self, pattern, tracks, stems):
+        self.done[self.key(pattern, tracks)] = {os.path.relpath(path, self.projectpath): frames
+                                               for path, frames in stems.items()}
+        self.save()
+
+    def is_done(self, pattern, tracks):
+        """True if the take finished and all its stems are still on disk with the recorded length"""
+        stems = self.done.get(self.key(pattern, tracks))
+        if stems is None:
+            return False
+        return all(verifyStem(os.path.join(self.projectpath, path), frames) for path, frames in stems.items())
+
+
+def readWavHeader(path):
+    """(channels, sampwidth, rate, data offset, data bytes) of a WAV or RF64 file"""
+    with open(path, 'rb') as f:
+        riff, riff_size, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+            raise ValueError("not a wav file: " + path)
+        fmt = None
+        data_size64 = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("no data chunk: " + path)
+            chunk, size = struct.unpack('<4sI', header)
+            if chunk == b'data':
+                if fmt is None:
+                    raise ValueError("data before fmt chunk: " + path)
+                if size == 0xFFFFFFFF and data_size64 is not None:
+                    size = data_size64
+                return fmt[1], fmt[5] // 8, fmt[2], f.tell(), size
+            body = f.read(size + (size & 1))
+            if chunk == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', body[:16])
+            elif chunk == b'ds64':
+                data_size64 = struct.unpack('<QQQ', body[:24])[1]
+
+
+def verifyStem(path, frames):
+    """Check that a wav file is readable and holds the expected number of frames"""
+    try:
+        channels, sampwidth, rate, offset, data_bytes = readWavHeader(path)
+        # The header alone doesn't prove the data made it to disk
+        return data_bytes // (channels * sampwidth) == frames and os.path.getsize(path) >= offset + data_bytes
+    except (OSError, ValueError, struct.error):
+        return False
+
+
+def readWav(path):
+    """16 bit wav or RF64 as an int16 array of shape (frames, channels) and its sample rate"""
+    channels, sampwidth, rate, offset, data_bytes = readWavHeader(path)
+    data = np.fromfile(path, dtype='<i2', count=data_bytes // 2, offset=offset)
+    return data.reshape(-1, channels), rate
+
+
+def writeWav(path, samples, rate):
+    with wave.open(path, 'wb') as wf:
+        wf.setnchannels(samples.shape[1])
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(samples.astype('<i2').tobytes())
+
+
+def mapWav(path):
+    """Memory map of a 16 bit wav or RF64 as int16 (frames, channels) and its sample rate"""
+    channels, sampwidth, rate, offset, data_bytes = readWavHeader(path)
+    frames = data_bytes // (2 * channels)
+    if not frames:
+        return np.zeros((0, channels), dtype='<i2'), rate
+    return np.memmap(path, dtype='<i2', mode='r', offset=offset, shape=(frames, channels)), rate
+
+
+def stemLag(reference, stem, max_lag):
+    """Frames the stem runs late against the reference, from the peak of their cross-correlation"""
+    n = len(reference) + len(stem)
+    corr = np.fft.irfft(np.fft.rfft(reference, n) * np.conj(np.fft.rfft(stem, n)), n)
+    return max_lag - int(np.argmax(np.concatenate([corr[-max_lag:], corr[:max_lag + 1]])))
+
+
+def verifyStems(reference_path, stem_paths, tolerance=-20.0, window=0.05, max_lag=0.02, max_offset=0.001):
+    """Check that the stems of a pattern add up to a full mix take of it.
+
+    stem_paths maps track -> wav file, missing files count as silence. Returns the residual of
+    reference minus aligned sum of stems in dB relative to the reference and {track: problem}
+    for stems that are off the beat, hold another track's audio or drop out."""
+    reference, rate = mapWav(reference_path)
+    stems = {track: mapWav(path)[0] if os.path.exists(path) else None for track, path in stem_paths.items()}
+    tracks = sorted(stems)
+    n = min([len(reference)] + [len(stem) for stem in stems.values() if stem is not None and len(stem)])
+    #Mono float copies, the files themselves are only paged in
+    mix = reference[:n].mean(axis=1, dtype=np.float32)
+    audio = np.zeros((n, len(tracks)), dtype=np.float32)
+    for column, track in enumerate(tracks):
+        if stems[track] is not None and len(stems[track]):
+            audio[:, column] = stems[track][:n].mean(axis=1, dtype=np.float32)
+    energy = np.einsum('ij,ij->j', audio, audio)
+    problems = {}
+
+    max_lag = int(rate * max_lag)
+    for column in np.flatnonzero(energy):
+        late = stemLag(mix, audio[:, column], max_lag)
+        if abs(late) > rate * max_offset:
+            problems[tracks[column]] = "{:+.1f} ms off the mix".format(late / rate * 1000)
+        if late > 0:
+            audio[:, column] = np.concatenate([audio[late:, column], np.zeros(late, dtype=np.float32)])
+        elif late < 0:
+            audio[:, column] = np.concatenate([np.zeros(-late, dtype=np.float32), audio[:late, column]])
+    residual = mix - audio.sum(axis=1)
+    mix_energy = float(np.dot(mix, mix))
+    if not mix_energy:
+        return 0.0, problems
+    residual_db = 10 * np.log10(max(float(np.dot(residual, residual)), 1e-12) / mix_energy)
+
+    #A mute that didn't land leaves another track in the stem, a missed solo duplicates it
+    gram = audio.T @ audio
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #Share of stem j that is also in stem i, and how much of stem i it makes up
+        held = np.nan_to_num(gram / energy[None, :])
+        share = np.nan_to_num(gram / np.sqrt(np.outer(energy, energy)))
+    np.fill_diagonal(held, 0)
+    for i in np.flatnonzero(((held > 0.7) & (share > 0.3)).any(axis=1)):
+        problems.setdefault(tracks[i], "holds track {}".format(tracks[int(np.argmax(held[i]))] + 1))
+
+    #Digital silence in a stem where the mix doesn't add up is a dropout
+    size = int(rate * window)
+    count = n // size
+    if count:
+        mix_power = np.square(mix[:count * size]).reshape(count, size).mean(axis=1)
+        residual_power = np.square(residual[:count * size]).reshape(count, size).mean(axis=1)
+        silent = np.square(audio[:count * size]).reshape(count, size, -1).mean(axis=1) == 0
+        bad = (residual_power > mix_power * 10 ** (tolerance / 10)) & (mix_power > 1.0)
+        sounding = np.zeros_like(silent)
+        sounding[1:] |= ~silent[:-1]
+        sounding[:-1] |= ~silent[1:]
+        dropouts = silent & sounding & bad[:, None]
+        for column in np.flatnonzero(dropouts.any(axis=0)):
+            start = np.flatnonzero(dropouts[:, column])[0] * window
+            problems.setdefault(tracks[column], "drops out at {:.2f} s".format(start))
+
+    #Nothing to blame, a stem that stayed silent is the likely culprit
+    if residual_db > tolerance and not problems:
+        for column in np.flatnonzero(energy == 0):
+            problems[tracks[column]] = "silent but missing from the sum"
+    return float(residual_db), problems
+
+
+def resample(samples, rate, target_rate):
+    try:
+        from scipy.signal import resample_poly
+        from math import gcd
+        divisor = gcd(rate, target_rate)
+        return resample_poly(samples, target_rate // divisor, rate // divisor, axis=0)
+    except ImportError:
+        # Linear interpolation is good enough for previews, install scipy for delivery quality
+        n = int(round(samples.shape[0] * target_rate / rate))
+        positions = np.arange(n) * (rate / target_rate)
+        return np.stack([np.interp(positions, np.arange(samples.shape[0]), samples[:, c])
+                         for c in range(samples.shape[1])], axis=1)
+
+
+def postProcessStem(source, target, stages):
+    """Apply the post-processing stages to one stem. Runs in a worker process, returns the written file"""
+    samples, rate = readWav(source)
+    audio = samples.astype(np.float64)
+    if stages.get('dc'):
+        audio -= audio.mean(axis=0)
+    if stages.get('rate') and stages['rate'] != rate and audio.shape[0]:
+        audio = resample(audio, rate, stages['rate'])
+        rate = stages['rate']
+    if stages.get('normalize') and audio.size:
+        peak = np.max(np.abs(audio))
+        if stages['normalize'] == 'rms':
+            level = np.sqrt(np.mean(np.square(audio)))
+            gain = 32768 * 10 ** (stages.get('rms_target', -18) / 20.0) / level if level else 1.0
+            # Never push the peaks into clipping
+            gain = min(gain, 32767 * 10 ** (stages.get('peak_target', -1) / 20.0) / peak)
+        else:
+            gain = 32767 * 10 ** (stages.get('peak_target', -1) / 20.0) / peak if peak else 1.0
+        audio *= gain
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    writeWav(target, np.clip(np.round(audio), -32768, 32767), rate)
+    if stages.get('flac'):
+        flac_target = os.path.splitext(target)[0] + '.flac'
+        subprocess.run(['flac', '--silent', '--force', '--delete-input-file', '-o', flac_target, target], check=True)
+        return flac_target
+    return target
+
+
+class PostProcessor:
+    """Bounded queue of finished stems, processed on a process pool while the next take records.
+
+    Results go to a "processed" folder next to the raw stems, which stay untouched for resuming.
+    """
+
+    def __init__(self, projectpath, stages, workers=2, queue_size=8):
+        self.projectpath = projectpath
+        self.stages = stages
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.in_flight = threading.Semaphore(queue_size)
+        #Workers start while the audio callback, MIDI and writer threads run, a forked child could inherit a held lock
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.futures = []
+        self.errors = []
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    def submit(self, path):
+        """Queue a stem, blocks if the pool is this far behind"""
+        self.queue.put(path)
+
+    def feed(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            self.in_flight.acquire()
+            target = os.path.join(self.projectpath, 'processed', os.path.relpath(path, self.projectpath))
+            try:
+                future = self.pool.submit(postProcessStem, path, target, self.stages)
+            except Exception as e:
+                #A broken pool fails every stem, but the queue keeps draining so submit() and close() return
+                print("Post-processing error:", repr(e))
+                self.errors.append(e)
+                self.in_flight.release()
+                continue
+            future.add_done_callback(self.finished)
+            self.futures.append(future)
+
+    def finished(self, future):
+        self.in_flight.release()
+        if future.exception():
+            print("Post-processing error:", future.exception())
+            self.errors.append(future.exception())
+
+    def pending(self):
+        return self.queue.qsize() + sum(1 for future in self.futures if not future.done())
+
+    def close(self):
+        """Wait for everything queued so far and shut the pool down"""
+        self.queue.put(None)
+        self.feeder.join()
+        self.pool.shutdown(wait=True)
+
+
+def discoverUnits():
+    """Connected OP-Z and OP-XY units as dicts with name, type, MIDI port and audio input index.
+    USB doesn't tell which MIDI port and audio input belong together, units of a type are paired in enumeration order"""
+    ports = mido.get_output_names()
+    p = pyaudio.PyAudio()
+    try:
+        inputs = []
+        for i in range(p.get_host_api_info_by_index(0).get('deviceCount')):
+            info = p.get_device_info_by_host_api_device_index(0, i)
+            if info.get('maxInputChannels') > 0:
+                inputs.append((info['index'], info['name']))
+    finally:
+        p.terminate()
+    units = []
+    for device_type in ("OP-Z", "OP-XY"):
+        type_ports = [name for name in ports if device_type in name]
+        type_inputs = [index for index, name in inputs if device_type in name]
+        if len(type_ports) != len(type_inputs):
+            print("{} MIDI ports but {} audio inputs for {}, pairing the first {}".format(
+                len(type_ports), len(type_inputs), device_type, min(len(type_ports), len(type_inputs))))
+        for nr, (port, index) in enumerate(zip(type_ports, type_inputs)):
+            units.append({'name': "{}-{}".format(device_type, nr + 1), 'type': device_type,
+                          'midi': port, 'audio': index})
+    return units
+
+
+MODIFIERS = ('send1', 'send2', 'tape', 'master', 'perform', 'module')
+MODES = ('pattern', 'project', 'chain')
+
+
+@dataclass
+class ExportParams:
+    """Everything an export needs, filled in by the GUI, the command line or a batch job file"""
+    name: str = "Name"
+    projectpath: str = ""  # folder the stems are written to
+    device: str = "OP-Z"  # preferred unit type, the other one is auto-detected as fallback
+    mode: str = "pattern"  # one of MODES, chain is the 1-Pass project mode
+    bpm: float = 0.0
+    bars: int = 1
+    patterns: int = 16
+    extra_seconds: int = 0
+    exclude: list = field(default_factory=lambda: [0] * len(MODIFIERS))  # 1 mutes the modifier track
+    probe: bool = False
+    placeholders: bool = False
+    adaptive_tail: bool = False
+    auto_tempo: bool = False
+    resume: bool = False
+    post_flac: bool = False
+    post_normalize: str = None  # 'peak' or 'rms'
+    post_dc: bool = False
+    post_rate: int = None
+    frames_per_buffer: int = 128
+    buffer_seconds: float = 2.0
+    probe_bars: int = 1
+    tail_threshold: float = -60
+    tail_hold: float = 0.5
+    post_workers: int = 2
+    channel_map: list = None  # [[track, first input channel], ...] 1-based, for interfaces with more than one stereo pair
+    all_units: bool = False  # export every connected unit in parallel, one subfolder each
+    midi_port: str = None  # pin the export to one unit instead of the first one found
+    audio_device: int = None  # PortAudio input index of that unit
+    reconnect_timeout: float = 600.0  # seconds to wait for a unit that dropped off USB, 0 stops the export instead
+    verify: bool = False  # record a full mix per pattern and check the stems add up to it
+    verify_tolerance: float = -20.0  # dB of residual against the full mix that still passes
+
+    def validate(self):
+        """Raise ValueError for settings an export can't run with"""
+        if self.mode not in MODES:
+            raise ValueError("mode must be one of " + ", ".join(MODES))
+        if self.device not in ("OP-Z", "OP-XY"):
+            raise ValueError("device must be OP-Z or OP-XY")
+        if not self.projectpath:
+            raise ValueError("no output directory set")
+        if self.bpm <= 0 and not self.auto_tempo:
+            raise ValueError("BPM must be set unless the tempo comes from the clock")
+        if len(self.exclude) != len(MODIFIERS):
+            raise ValueError("exclude needs one flag per modifier")
+        for track, channel in self.channel_map or []:
+            if not 1 <= track <= 8 or channel < 1:
+                raise ValueError("channel map entries need a track 1-8 and an input channel from 1")
+        if self.verify and self.channel_map:
+            raise ValueError("stem verification needs the full mix on one stereo pair, not a channel map")
+
+    def loop_time(self):
+        return 240 / self.bpm * self.bars + self.extra_seconds
+
+
+class ExportEngine:
+    """Runs an export from an ExportParams, without any GUI. Status messages go to the status callback"""
+    REPORT_NAME = 'underbridge_report.json'
+    VERIFY_RETAKES = 1  # rounds of retakes for stems that don't add up to the full mix
+
+    def __init__(self, params, status=print, meter=None):
+        self.params = params
+        self.status = status
+        self.meter = meter  # optional, gets {track: (peak dBFS, RMS dBFS)} of the running take
+        self.supervisor = None  # ConnectionSupervisor of the open session during an export
+        self.lost_reason = None
+        #device_list = []
+        self.op_device = []
+        self.audio_device = None  # Initialize to None for proper detection checking
+        self.addsec = params.extra_seconds
+        self.loop_time = 0
+        self.bar_time = 0  # pattern length without the extra seconds
+        self.bar_count = 1
+        if params.bpm:
+            self.applyTempo(params.bpm, params.bars)
+        self.probe_bars = params.probe_bars  # length of the silent track probe
+        self.sends_position = None  # whether the device reports song position, None until the first tempo detection
+        self.postprocessor = None
+        self.post_workers = params.post_workers
+        self.tail_threshold = params.tail_threshold  # dBFS, adaptive tail ends below this level
+        self.tail_hold = params.tail_hold  # seconds the level has to stay below tail_threshold
+        self.outport = 0
+        self.device_interface = None  # Device abstraction instance
+        self.session = None  # AudioMidiSession shared by all takes of an export
+        self.pattern_nr = 0
+        self.current_task = None  # (pattern, track) being recorded, reported when a take fails
+        self.pattern_stepped = False  # the unit echoed the last pattern step
+        self.warnings = []  # repeated in the final status
+        self.projectpath = params.projectpath
+        self.cancel = 0
+        self.RATE = 0
+        self.CHUNK = params.frames_per_buffer  # frames per PortAudio callback
+        self.buffer_seconds = params.buffer_seconds  # ring buffer between the audio callback and the disk writer
+        self.settings = loadSettings()
+        self.detected_device_type = None  # Store detected device type
+        self.mute_list =[0] * 14 #Midi mute selection of all 14 necessary channels
+        self.input_channels = 2  # inputs the audio device offers
+        # track -> first input channel, 0-based. Tracks not in the map come in on the first pair
+        self.channel_map = {track - 1: channel - 1 for track, channel in params.channel_map or []}
+        self.stats = PerfStats()  # timings of this export, saved as REPORT_NAME in the project folder
+        self.stats.info.update({'name': params.name, 'mode': params.mode})
+
+    def run(self):
+        """Run the whole export, returns True if it finished"""
+        os.makedirs(self.projectpath, exist_ok=True)
+        return self.sequenceMaster()
+
+    def getMIDIDevice(self):   
+        #global device_list
+        #global op_device
+        if self.params.midi_port:
+            #Pinned to one unit by a multi unit export
+            self.op_device = self.params.midi_port
+            self.detected_device_type = "OP-XY" if "OP-XY" in self.op_device else "OP-Z"
+            self.status("{} found".format(self.detected_device_type))
+            return
+
+        device_list = mido.get_output_names()
+        print (device_list)
+        
+        # Try to detect based on user selection first, then auto-detect
+        selected_device = self.params.device
+        device_found = False
+        
+        if selected_device == "OP-Z":  # User selected OP-Z
+            try: 
+                self.op_device = list(filter(lambda x: 'OP-Z' in x, device_list))        
+                self.op_device = self.op_device[0]
+                self.detected_device_type = "OP-Z"
+                self.status("OP-Z found")
+                device_found = True
+            except:
+                pass
+        elif selected_device == "OP-XY":  # User selected OP-XY
+            try:
+                self.op_device = list(filter(lambda x: 'OP-XY' in x, device_list))
+                self.op_device = self.op_device[0]
+                self.detected_device_type = "OP-XY"
+                self.status("OP-XY found")
+                device_found = True
+            except:
+                pass
+        
+        # If selected device not found, try auto-detection
+        if not device_found:
+            try: 
+                self.op_device = list(filter(lambda x: 'OP-Z' in x, device_list))        
+                self.op_device = self.op_device[0]
+                self.detected_device_type = "OP-Z"
+                self.status("OP-Z found (auto-detected)")
+                device_found = True
+            except:
+                pass
+        
+        if not device_found:
+            try:
+                self.op_device = list(filter(lambda x: 'OP-XY' in x, device_list))
+                self.op_device = self.op_device[0]
+                self.detected_device_type = "OP-XY"
+                self.status("OP-XY found (auto-detected)")
+                device_found = True
+            except:
+                pass
+        
+        if not device_found:
+            self.status("Can't find OP-Z or OP-XY: MIDI Error.")
+
+    def getMIDIInput(self):
+        #Input port of the same unit, used for clock and echo feedback
+        input_list = mido.get_input_names()
+        if self.op_device in input_list:
+            return self.op_device
+        matches = [name for name in input_list if (self.detected_device_type or "OP-Z") in name]
+        if self.params.midi_port:
+            #Pinned by a multi unit export, pair by enumeration order like discoverUnits. Another unit's
+            #clock and echoes would throw off tempo detection and the echo waits, so no fallback
+            outputs = [name for name in mido.get_output_names() if self.detected_device_type in name]
+            if self.op_device in outputs and len(matches) == len(outputs):
+                return matches[outputs.index(self.op_device)]
+            return None
+        return matches[0] if matches else None
+
+    def getAudioDevice(self):
+        #global audio_device
+        #global RATE
+        if self.params.audio_device is None:
+            #Search from scratch, after a reconnect the old index may belong to another device by now
+            self.audio_device = None
+        p = pyaudio.PyAudio()
+        try:
+            if self.params.audio_device is None and self.useProfile(p):
+                return
+            self.probeAudioDevice(p)
+        finally:
+            p.terminate()
+
+    def useProfile(self, p):
+        #Same unit as last time: take index, rate and channels from the cache instead of probing
+        profile = self.settings.get('device_profiles', {}).get(self.op_device or '')
+        if not profile:
+            return False
+        try:
+            devinfo = p.get_device_info_by_index(profile['audio_index'])
+        except (IOError, ValueError):
+            return False
+        if devinfo['name'] != profile['audio_name'] or int(devinfo['maxInputChannels']) != profile['channels']:
+            return False
+        self.audio_device = profile['audio_index']
+        self.input_channels = profile['channels']
+        self.RATE = profile['rates'][0]
+        print("Cached profile:", profile['audio_name'], "at Index:", self.audio_device, self.RATE)
+        return True
+
+    def probeAudioDevice(self, p):
+        try:
+            info = p.get_host_api_info_by_index(0)
+            numdevices = info.get('deviceCount')
+            for i in range(0, numdevices):
+                if (p.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
+                    print("Input Device id ", i, " - ", p.get_device_info_by_host_api_device_index(0, i).get('name'))
+            
+            # Search for the device based on detected type or user selection
+            device_search_name = None
+            if self.detected_device_type:
+                device_search_name = self.detected_device_type
+            else:
+                device_search_name = self.params.device
+            
+            if self.params.audio_device is not None:
+                self.audio_device = self.params.audio_device
+                numdevices = 0
+            for i in range(0, numdevices):
+                device_name = p.get_device_info_by_host_api_device_index(0, i).get('name')
+                max_channels = p.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')
+                
+                if device_search_name and device_search_name in device_name and max_channels > 0:
+                    self.audio_device = i
+                    print(f"Detected {device_search_name} audio at Index:", self.audio_device, device_name)
+                    break
+            
+            if not hasattr(self, 'audio_device') or self.audio_device is None:
+                self.status(f"{device_search_name or 'Device'} Audio Device not found.")
+        except Exception as e:
+            self.status(f"Audio Device Error: {str(e)}")
+
+        if self.audio_device is None:
+            self.RATE = 44100
+            return
+        devinfo = p.get_device_info_by_index(self.audio_device)
+        self.input_channels = int(devinfo['maxInputChannels'])
+        rates = []
+        for rate in (48000, 44100):
+            try:
+                p.is_format_supported(rate, input_device=devinfo['index'], input_channels=devinfo['maxInputChannels'],
+                                      input_format=pyaudio.paInt16)
+                rates.append(rate)
+            except ValueError:
+                pass
+        if not rates:
+            rates = [44100]
+        self.RATE = rates[0]
+        print("48kHz" if self.RATE == 48000 else "44100kHz compatibility mode")
+        if self.op_device and self.params.audio_device is None:
+            self.settings = updateSettings('device_profiles', self.op_device,
+                                           {'audio_index': self.audio_device, 'audio_name': devinfo['name'],
+                                            'channels': self.input_channels, 'rates': rates})
+
+    def discoverDevice(self):
+        #MIDI port and audio input, from the cached profile when the unit didn't change
+        with self.stats.timer('discover'):
+            self.getMIDIDevice()
+            self.getAudioDevice()
+
+    def getBPM(self):        
+        #Play muted for a moment and read the tempo from the MIDI clock the device sends
+        self.getMIDIDevice()
+        input_name = self.getMIDIInput()
+        if not input_name:
+            self.status("No MIDI input from the device, enter the BPM by hand.")
+            return None
+        listener = MidiListener(input_name)
+        outport = mido.open_output(self.op_device)
+        device = OPXYDevice(outport) if self.detected_device_type == "OP-XY" else OPZDevice(outport)
+        try:
+            listener.open()
+            #The 8 tracks stay muted while the clock is measured, the modifiers are left alone
+            device.set_mutes([1] * 8)
+            time.sleep(device.mute_settle)
+            device.start_playback()
+            listener.wait_ticks(49, 3.0)
+            device.stop_playback()
+        finally:
+            try:
+                device.set_mutes([0] * 8)
+            except Exception as e:
+                print("Could not unmute:", repr(e))
+            listener.close()
+            outport.close()
+        bpm = listener.bpm()
+        if bpm is None:
+            self.status("No MIDI clock received. Enable clock out on the device.")
+            return None
+        self.status("Detected {:.1f} BPM".format(bpm))
+        return bpm
+
+    def applyTempo(self, bpm, bars):
+        self.bar_time = 240 / bpm * bars
+        self.bar_count = bars
+        self.loop_time = self.bar_time + self.addsec
+
+    def detectTempo(self):
+        #Measure BPM and pattern length of the current pattern from the clock while all tracks are muted
+        listener = self.session.listener
+        if not listener:
+            return False
+        self.muteAll()
+        self.start_MIDI()
+        listener.wait_ticks(49, 3.0)
+        bpm = listener.bpm()
+        if bpm is not None and self.sends_position is not False:
+            #Nr. Bars is the longest pattern, play until the device reports the loop point
+            listener.wait_loop(240 / bpm * self.params.bars + 0.5)
+            self.sends_position = listener.song_position is not None
+        self.stop_MIDI()
+        if bpm is None:
+            print("No MIDI clock, keeping", self.loop_time)
+            return False
+        bars = listener.pattern_bars() or self.params.bars
+        self.applyTempo(bpm, bars)
+        print("Pattern", self.pattern_nr, "at {:.2f} BPM, {} bars, loop time {:.2f}".format(bpm, bars, self.loop_time))
+        self.session.wait_idle(self.device_interface.stop_timeout)
+        return True
+
+    def openSession(self):
+        #Audio stream and MIDI port stay open for the whole export, takes are cut out of the stream
+        channels = 2
+        if self.channel_map:
+            #Open every input, the channel map picks the pairs out of the interleaved stream
+            channels = self.input_channels
+            if max(self.channel_map.values()) + 2 > channels:
+                raise ValueError("Channel map needs more than the {} inputs of the audio device".format(channels))
+        self.session = AudioMidiSession(self.op_device, self.detected_device_type, self.audio_device, self.RATE,
+                                        channels=channels, frames_per_buffer=self.CHUNK, buffer_seconds=self.buffer_seconds,
+                                        midi_input_name=self.getMIDIInput(), stats=self.stats)
+        self.session.open()
+        self.session.set_start_offset(self.getStartOffset())
+        self.outport = self.session.outport
+        self.device_interface = self.session.device
+
+    def getStartOffset(self):
+        return self.settings.get('start_offset', {}).get(self.detected_device_type or "OP-Z", 0.0)
+
+    def calibrateLatency(self):
+        #One time loopback measurement: the pattern needs a hit on the first step with all tracks unmuted
+        self.discoverDevice()
+        self.status("Calibrating...")
+        try:
+            self.openSession()
+            self.session.set_start_offset(0.0)
+            self.unmuteAll()
+            sink = BufferSink()
+            self.session.engine.record(sink, int(self.RATE * 2), on_start=self.start_MIDI)
+            self.stop_MIDI()
+            samples = np.abs(np.frombuffer(bytes(sink.data), dtype='<i2').astype(np.int32))
+            onset = np.flatnonzero(samples > 1000)  # about -30 dBFS
+            if onset.size == 0:
+                self.status("Calibration failed: no audio. Unmute a track that plays on step 1.")
+                return
+            offset = float(onset[0] // self.session.channels) / self.RATE
+            self.settings = updateSettings('start_offset', self.detected_device_type or "OP-Z", offset)
+            print("Start latency calibrated:", offset)
+            self.status("Calibrated start latency: {:.1f} ms".format(offset * 1000))
+        except Exception as e:
+            self.status("Calibration error: {}".format(e))
+        finally:
+            self.closeSession()
+
+    def restoreMutes(self):
+        #Takes leave the last solo in place, hand the device back with everything audible
+        if not self.device_interface:
+            return
+        try:
+            self.unmuteAll()
+        except Exception as e:
+            print("Could not unmute:", repr(e))
+
+    def startSupervisor(self):
+        if self.params.reconnect_timeout > 0:
+            self.supervisor = ConnectionSupervisor(self.session)
+            self.supervisor.start()
+
+    def connectionLost(self):
+        #Ask the supervisor right away, an error can come before its next check
+        return bool(self.supervisor) and self.supervisor.check()
+
+    def reconnect(self):
+        #Pause until the unit is back, reopen its ports and restore the mutes. False if it didn't come back
+        reason = self.lost_reason = self.supervisor.reason
+        self.stats.count('reconnects')
+        self.closeSession()
+        self.status("Connection lost ({}). Waiting for the device...".format(reason))
+        deadline = time.monotonic() + self.params.reconnect_timeout
+        while self.cancel != 1 and time.monotonic() < deadline:
+            time.sleep(1.0)
+            try:
+                if self.op_device not in mido.get_output_names():
+                    if self.params.midi_port:
+                        continue
+                    #The port name can change when the unit re-enumerates, look it up by type again
+                    self.getMIDIDevice()
+                    if not self.op_device:
+                        continue
+                self.getAudioDevice()
+                if self.audio_device is None:
+                    raise IOError("audio input not back yet")
+                self.openSession()
+            except Exception as e:
+                print("Reconnect failed:", repr(e))
+                self.closeSession()
+                continue
+            #Mute state on the device is unknown now, send all of it
+            self.setMutes(self.mute_list)
+            self.startSupervisor()
+            self.status("Device is back, continuing")
+            return True
+        return False
+
+    def supervised(self, action, *args):
+        #Run a step of the export, after a lost connection wait for the unit and run the step again
+        while True:
+            try:
+                result = action(*args)
+                if not self.connectionLost():
+                    return result
+            except Exception:
+                if self.cancel == 1 or not self.connectionLost():
+                    raise
+            if self.cancel == 1:
+                return None
+            if not self.reconnect():
+                if self.cancel == 1:
+                    return None
+                raise IOError("Device did not come back: {}".format(self.lost_reason))
+            if self.params.mode == 'chain':
+                self.device_interface.return_to_start()
+
+    def closeSession(self):
+        if self.supervisor:
+            self.supervisor.stop()
+            self.supervisor = None
+        if self.session:
+            self.session.close()
+            self.session = None
+        self.device_interface = None
+
+    def setProject(self,projnr):
+        msg= mido.Message('program_change',song= self.projnr, program = 1)
+        self.outport.send(msg)
+
+    def muteList(self, solo=()):
+        #All tracks muted except the soloed ones, modifier tracks as excluded in the settings
+        for j in range (0,8):
+            self.mute_list[j] = int(j not in solo)
+        
+        for i in range (1,7):
+            self.mute_list[i+7] = int(self.params.exclude[i-1])       #9th position in mute list  
+        return self.mute_list
+
+    def setMutes(self, mute_list):
+        #Only channels whose state changes are sent, returns them
+        if self.device_interface:
+            with self.stats.timer('midi_send'):
+                return self.device_interface.set_mutes(mute_list)
+        # Fallback to direct messages if device interface not initialized
+        for k in range (0,14):
+            msg = mido.Message('control_change',control= 53, channel= k, value= mute_list[k])
+            self.outport.send(msg)
+        return list(range(14))
+
+    def muteAll(self):        
+        return self.setMutes(self.muteList())
+        #print("Muted Channels",self.mute_list)
+
+    def start_MIDI(self):        
+        if self.session and self.session.listener:
+            self.session.listener.mark_start()
+        if self.device_interface:
+            with self.stats.timer('midi_send'):
+                self.device_interface.start_playback()
+        else:
+            msg = mido.Message('start')
+            self.outport.send(msg)
+        self.status("Playback started")
+        #print("midi")
+
+    def stop_MIDI(self):        
+        if self.device_interface:
+            self.device_interface.stop_playback()
+        else:
+            msg = mido.Message('stop')
+            self.outport.send(msg)
+        self.status("Playback stopped")
+
+    def unmuteAll(self):        
+        return self.setMutes([0] * 14)
+
+    def nextPattern(self):        
+        if self.device_interface:
+            self.device_interface.next_pattern()
+        else:
+            msg = mido.Message('control_change', control = 103, value = 16)
+            self.outport.send(msg)
+        self.status("Next Pattern")
+
+    def nextSong(self):
+        pass
+
+    def closeMidi(self):           
+        self.closeSession()
+        self.status("MIDI closed")     
+
+    def makeDirNr(self, pattern_nr):    
+        #global projectpath    
+        #Pfad wird addiert deswegen zusätzliche verzeichnisse
+        #projectpath = projectpath + '/' + str(pattern_nr)
+        #Resumed exports find the folders already there
+        try:
+            os.makedirs(self.projectpath + '/' + str(pattern_nr), exist_ok=True)
+        except OSError as e:
+            self.status("Directory Error: {}".format(e))
+        #print(projectpath)
+
+    def tailDetector(self, min_frames):
+        #With adaptive tail the extra seconds are only the upper limit
+        if not self.params.adaptive_tail:
+            return None
+        return TailDetector(min_frames, int(self.RATE * self.tail_hold), self.tail_threshold, self.session.channels)
+
+    def trackPath(self, track):
+        WAVE_OUTPUT_FILENAME =  self.params.name + "_" + "track" + str(track+1) + ".wav"       
+        #print(WAVE_OUTPUT_FILENAME)
+        if self.params.mode == 'project':
+            return self.projectpath + '/' + str(self.pattern_nr) + '/' + WAVE_OUTPUT_FILENAME
+        return self.projectpath + '/' + WAVE_OUTPUT_FILENAME
+
+    def takeStats(self, take, kind, tracks):
+        #Label the capture figures of a take and add them to the report
+        label = "{} {} track {}".format(kind, 'all' if kind == 'chain' else self.pattern_nr,
+                                        '+'.join(str(track + 1) for track in tracks))
+        figures = dict(take.stats, label=label, aborted=take.aborted)
+        self.stats.add_take(figures)
+        print("Take {}: {frames} frames, MIDI send {midi_send_ms} ms, late {late_ms} ms, jitter {jitter_ms} ms, "
+              "xruns {xruns}, write {write_ms} ms".format(label, **take.stats))
+
+    def levelMeter(self, tracks):
+        #Per track levels of a take from the channel pair each track comes in on
+        if not self.meter:
+            return None
+        pairs = {track: self.channel_map.get(track, 0) for track in tracks}
+
+        def report(levels):
+            track_levels = {}
+            for track, first in pairs.items():
+                peaks, rms = zip(*levels[first:first + 2])
+                power = np.mean(np.power(10.0, np.array(rms) / 10))
+                with np.errstate(divide='ignore'):
+                    track_levels[track] = (max(peaks), float(10 * np.log10(power)))
+            self.meter(track_levels)
+
+        return LevelMeter(self.session.channels, report)
+
+    def trackGroups(self):
+        #Tracks that can share a pass because they come in on different channel pairs
+        groups = []
+        for track in range(8):
+            pair = self.channel_map.get(track, 0)
+            for tracks, pairs in groups:
+                if pair not in pairs:
+                    tracks.append(track)
+                    pairs.add(pair)
+                    break
+            else:
+                groups.append(([track], {pair}))
+        return [tuple(tracks) for tracks, pairs in groups]
+
+    def trackSink(self, sinks):
+        #Route each track's channel pair to its sink, a plain stereo stream needs no splitting
+        if self.session.channels == 2 and len(sinks) == 1:
+            return next(iter(sinks.values()))
+        return ChannelSplitSink([(self.channel_map.get(track, 0), sink) for track, sink in sinks.items()],
+                                self.session.channels)
+
+    def start_Rec(self, tracks):
+        #print("record")
+        self.status("Recording...")
+        engine = self.session.engine
+        
+        RECORD_SECONDS= self.loop_time
+        #print("record")
+        #Length is known up front, the stems are preallocated and filled through a memory map
+        writers = {track: MappedWavWriter(self.trackPath(track), 2, engine.sampwidth, self.RATE,
+                                          int(self.RATE * RECORD_SECONDS))
+                   for track in tracks}
+
+        #print("* recording")
+        # Blocks go straight to disk so memory stays flat and a crash keeps the take so far
+        with self.trackSink(writers) as sink:
+            take = engine.record(sink, int(self.RATE * RECORD_SECONDS), on_start=self.start_MIDI,
+                                 tail=self.tailDetector(int(self.RATE * self.bar_time)),
+                                 meter=self.levelMeter(tracks))
+        #print("Done recording")
+
+        self.takeStats(take, 'pattern', tracks)
+        if take.stats['xruns']:
+            self.status("End of Recording ({} overflows)".format(take.stats['xruns']))
+        else:
+            self.status("End of Recording")
+        if take.aborted:
+            return None
+        return {writer.filename: writer.frames_written() for writer in writers.values()}
+
+    def sequenceMaster(self):       
+        self.cancel = 0
+        self.warnings = []
+        self.sends_position = None
+        self.current_task = None
+        result = 'failed'
+        try:        
+            self.discoverDevice()
+            self.status("Sequence started")
+            self.openSession()
+            self.startSupervisor()
+            self.startPostProcessing()
+            self.runTasks(self.buildTasks())
+            result = 'cancelled' if self.cancel == 1 else 'finished'
+            return True
+        except Exception as e:
+            print("Sequence error:", repr(e))
+            if isinstance(e, ValueError):
+                self.status(str(e))
+            elif self.current_task:
+                pattern, tracks = self.current_task
+                self.status("Error at pattern {} track {}. Tick Resume and press RECORD to continue."
+                                    .format('all' if pattern is None else pattern + 1,
+                                            '+'.join(str(track + 1) for track in tracks)))
+            else:
+                self.status("OP-Z Sequence error try restarting the OP-Z or press CANCEL Button")
+        finally:
+            self.restoreMutes()
+            self.closeSession()
+            self.finishPostProcessing(result)
+            self.stats.info.update({'device': self.detected_device_type, 'result': result})
+            if os.path.isdir(self.projectpath):
+                self.stats.write(os.path.join(self.projectpath, self.REPORT_NAME))
+        return False
+
+    def postStages(self):
+        stages = {}
+        if self.params.post_flac:
+            stages['flac'] = True
+        if self.params.post_normalize:
+            stages['normalize'] = self.params.post_normalize
+        if self.params.post_dc:
+            stages['dc'] = True
+        if self.params.post_rate:
+            stages['rate'] = self.params.post_rate
+        return stages
+
+    def startPostProcessing(self):
+        stages = self.postStages()
+        if stages.get('flac') and not shutil.which('flac'):
+            self.warn("flac encoder not found, FLAC skipped")
+            stages.pop('flac')
+        if stages.get('rate'):
+            if importlib.util.find_spec('scipy'):
+                self.stats.info['resampler'] = 'scipy resample_poly'
+            else:
+                #resample() falls back to plain interpolation in the workers, say so once here
+                self.stats.info['resampler'] = 'linear interpolation, no anti-alias filter'
+                self.warn("scipy not found, resampled without anti-alias filter")
+        if stages:
+            self.postprocessor = PostProcessor(self.projectpath, stages, workers=self.post_workers)
+
+    def finishPostProcessing(self, result):
+        #Recorded stems are processed either way, the status line keeps an error or cancel message
+        if not self.postprocessor:
+            return
+        report = self.status if result == 'finished' else print
+        pending = self.postprocessor.pending()
+        if pending:
+            report("Post-processing {} stems...".format(pending))
+        self.postprocessor.close()
+        errors = len(self.postprocessor.errors)
+        self.postprocessor = None
+        if errors:
+            report("Post-processing failed for {} stems, see console".format(errors))
+        elif pending and result == 'finished':
+            self.status(self.finishedMessage())
+
+    def warn(self, message):
+        #Status messages are gone with the next take, warnings are repeated in the final status and the report
+        self.warnings.append(message)
+        self.stats.info['warnings'] = list(self.warnings)
+        self.status(message)
+
+    def finishedMessage(self):
+        #The last status stays on screen, so failed verification and warnings are named in it
+        message = "Export finished"
+        failed = self.stats.counters['verify_failed']
+        if failed:
+            message += ", {} stems failed verification".format(failed)
+        return ". ".join([message] + self.warnings)
+
+    def buildTasks(self):
+        #(pattern, tracks) jobs in recording order, pattern None is the whole chain in 1-Pass mode
+        mode = self.params.mode
+        groups = self.trackGroups()
+        if mode == 'chain':
+            return [(None, tracks) for tracks in groups]
+        if mode == 'project':
+            return [(pattern, tracks) for pattern in range(self.params.patterns) for tracks in groups]
+        return [(0, tracks) for tracks in groups]
+
+    def runTasks(self, tasks):
+        mode = self.params.mode
+        patterns = self.params.patterns
+        checkpoint = ExportCheckpoint(self.projectpath, {'name': self.params.name, 'mode': mode,
+                                                          'patterns': patterns if mode != 'pattern' else 1})
+        if self.params.resume and checkpoint.load():
+            print("Resuming from", checkpoint.path)
+        pattern_order = []
+        for pattern, tracks in tasks:
+            if pattern not in pattern_order:
+                pattern_order.append(pattern)
+
+        for index, pattern in enumerate(pattern_order):
+            if self.cancel == 1:
+                break
+            if index > 0:
+                self.pattern_stepped = False
+                self.supervised(self.advancePattern)
+            todo = [tracks for p, tracks in tasks if p == pattern and not checkpoint.is_done(p, tracks)]
+            if not todo:
+                continue
+            self.pattern_nr = pattern or 0
+            if mode == 'project':
+                self.makeDirNr(self.pattern_nr)
+            elif mode == 'chain':
+                for pattern_nr in range(patterns):
+                    self.makeDirNr(pattern_nr)
+            silent_tracks = self.supervised(self.preparePattern, mode) or set()
+
+            held = {}
+            for tracks in todo:
+                if self.cancel == 1:
+                    break
+                self.current_task = (pattern, tracks)
+                #Only the interrupted take is recorded again if the unit drops off
+                stems = self.supervised(self.runTask, pattern, tracks, silent_tracks)
+                if stems is not None:
+                    checkpoint.mark_done(pattern, tracks, stems)
+                    if self.params.verify:
+                        held.update(stems)
+                    else:
+                        self.submitStems(stems)
+            if self.params.verify and self.cancel != 1:
+                #Post-processing waits for the check, a retake rewrites the stem in place
+                held.update(self.supervised(self.verifyTakes, pattern, silent_tracks, checkpoint) or {})
+            self.submitStems(held)
+        self.current_task = None
+        if self.cancel != 1:
+            self.status(self.finishedMessage())
+
+    def preparePattern(self, mode):
+        #Per pattern measurements before the takes, returns the tracks to skip
+        if self.params.auto_tempo:
+            self.detectTempo()
+            if mode == 'chain':
+                self.device_interface.return_to_start()
+        if self.loop_time <= 0:
+            #Without a length every take would come out empty
+            raise ValueError("No tempo: the device sends no MIDI clock, set the BPM")
+        if self.params.probe and mode != 'chain':
+            return self.probeTracks()
+        return set()
+
+    def runTask(self, pattern, tracks, silent_tracks):
+        #Record one pass, returns {stem path: frames} or None if it was cancelled
+        device = self.device_interface
+        stems = {}
+        for track in tracks:
+            if track in silent_tracks:
+                stems.update(self.skipTrack(track))
+        tracks = [track for track in tracks if track not in silent_tracks]
+        if not tracks:
+            return stems
+        self.soloTracks(tracks)
+        if pattern is None:
+            recorded = self.start_ProjectRec(tracks, self.params.patterns)
+            self.session.wait_idle(device.stop_timeout)
+            device.return_to_start()
+        else:
+            #starting Midi during wave record for timing                     
+            recorded = self.start_Rec(tracks)               
+            self.stop_MIDI()
+            self.session.wait_idle(device.stop_timeout)
+        if recorded is None:
+            return None
+        stems.update(recorded)
+        return stems
+
+    def submitStems(self, stems):
+        if self.postprocessor:
+            for path, frames in stems.items():
+                if frames:
+                    self.postprocessor.submit(path)
+
+    def recordReference(self, pattern):
+        #Unmuted take of the pattern, or of every pattern in 1-Pass mode, returns {stem folder: reference file}
+        self.status("Recording full mix reference...")
+        engine = self.session.engine
+        device = self.device_interface
+        self.soloTracks(range(8))
+        if pattern is None:
+            patterns = self.params.patterns
+            pattern_frames = int(self.RATE * self.bar_time)
+            total_frames = pattern_frames * patterns + int(self.RATE * self.addsec)
+            folders = [self.projectpath + '/' + str(pattern_nr) for pattern_nr in range(patterns)]
+            lengths = [pattern_frames] * (patterns - 1) + [total_frames - pattern_frames * (patterns - 1)]
+        else:
+            total_frames = int(self.RATE * self.loop_time)
+            folders = [os.path.dirname(self.trackPath(0))]
+            lengths = [total_frames]
+        writers = [MappedWavWriter(folder + '/' + self.params.name + "_reference.wav", 2, engine.sampwidth, self.RATE, frames)
+                   for folder, frames in zip(folders, lengths)]
+        with SplitSink(writers, lengths, 2 * engine.sampwidth) as sink:
+            take = engine.record(sink, total_frames, on_start=self.start_MIDI, meter=self.levelMeter(range(8)))
+        self.takeStats(take, 'reference', range(8))
+        self.stop_MIDI()
+        self.session.wait_idle(device.stop_timeout)
+        if pattern is None:
+            device.return_to_start()
+        if take.aborted:
+            return None
+        return {folder: writer.filename for folder, writer in zip(folders, writers)}
+
+    def verifyTakes(self, pattern, silent_tracks, checkpoint):
+        #Check the stems against a full mix and retake the failing ones, returns the retaken stems
+        references = self.recordReference(pattern)
+        if references is None:
+            return None
+        retaken = {}
+        for attempt in range(self.VERIFY_RETAKES + 1):
+            failing = {}
+            for folder, reference in references.items():
+                stems = {track: folder + '/' + self.params.name + "_track" + str(track + 1) + ".wav" for track in range(8)}
+                with self.stats.timer('verify'):
+                    residual, problems = verifyStems(reference, stems, self.params.verify_tolerance)
+                self.stats.add_check({'reference': os.path.relpath(reference, self.projectpath), 'attempt': attempt,
+                                      'residual_db': round(residual, 1),
+                                      'problems': {str(track + 1): problem for track, problem in problems.items()}})
+                print("Verify {}: residual {:.1f} dB".format(reference, residual))
+                if residual > self.params.verify_tolerance and not problems:
+                    self.status("Stems are {:.1f} dB off the full mix, master effects don't add up".format(residual))
+                for track, problem in problems.items():
+                    failing.setdefault(track, problem)
+            if not failing:
+                self.status("Stems match the full mix")
+                return retaken
+            report = ", ".join("track {} {}".format(track + 1, problem) for track, problem in sorted(failing.items()))
+            if attempt == self.VERIFY_RETAKES:
+                self.stats.count('verify_failed', len(failing))
+                self.status("Verification failed: " + report)
+                return retaken
+            self.status("Retaking " + report)
+            #Only the takes holding a failing track, solo passes of the rest stay as they are
+            for tracks in self.trackGroups():
+                if self.cancel == 1:
+                    return retaken
+                if not failing.keys() & set(tracks):
+                    continue
+                self.current_task = (pattern, tracks)
+                stems = self.runTask(pattern, tracks, silent_tracks - set(tracks))
+                if stems is None:
+                    return None
+                checkpoint.mark_done(pattern, tracks, stems)
+                retaken.update(stems)
+        return retaken
+
+    def advancePattern(self):
+        #Runs again after a reconnect, once the unit echoed the step it isn't sent a second time
+        if self.pattern_stepped:
+            return
+        device = self.device_interface
+        self.session.wait_idle(device.pattern_timeout)
+        mark = self.session.feedback_mark()
+        self.nextPattern()
+        self.pattern_stepped = self.session.wait_feedback(lambda msg: msg.type in ('songpos', 'program_change') or
+                                                          (msg.type == 'control_change' and msg.control == 103),
+                                                          mark, device.pattern_settle)
+
+    def soloTracks(self, tracks):
+        #Going from one solo to the next only sends the CCs that differ, usually two
+        mark = self.session.feedback_mark()
+        changed = self.setMutes(self.muteList(tracks))
+        if not changed:
+            return
+        #continue as soon as the device echoes the last CC of the burst
+        self.session.wait_feedback(lambda msg: msg.type == 'control_change' and msg.control == 53 and msg.channel == changed[-1],
+                                   mark, self.device_interface.mute_settle)
+
+    def probeTracks(self):
+        #Short solo per pass, returns the tracks that play nothing in this pattern
+        device = self.device_interface
+        channels = self.session.channels
+        probe_frames = int(self.RATE * min(self.bar_time, self.bar_time / self.bar_count * self.probe_bars))
+        silent = set()
+        for tracks in self.trackGroups():
+            if self.cancel == 1:
+                break
+            self.status("Probing track {}".format('+'.join(str(track + 1) for track in tracks)))
+            self.soloTracks(tracks)
+            sink = BufferSink()
+            take = self.session.engine.record(sink, probe_frames, on_start=self.start_MIDI)
+            self.takeStats(take, 'probe', tracks)
+            self.stop_MIDI()
+            block = np.frombuffer(bytes(sink.data), dtype='<i2').reshape(-1, channels)
+            for track in tracks:
+                first = self.channel_map.get(track, 0)
+                peak, rms = levelsDbfs(block[:, first:first + 2])
+                if peak < device.silence_threshold:
+                    silent.add(track)
+            self.session.wait_idle(device.stop_timeout)
+        print("Silent tracks:", sorted(t + 1 for t in silent))
+        return silent
+
+    def skipTrack(self, track):
+        if not self.params.placeholders:
+            return {}
+        path = self.trackPath(track)
+        StreamingWavWriter(path, 2, self.session.engine.sampwidth, self.RATE).close()
+        return {path: 0}
+
+    def start_ProjectRec(self, tracks, patterns):
+        self.status("Recording track {} through {} patterns...".format('+'.join(str(track + 1) for track in tracks), patterns))
+        engine = self.session.engine
+        pattern_frames = int(self.RATE * self.bar_time)
+        total_frames = pattern_frames * patterns + int(self.RATE * self.addsec)
+        writers = []
+        splitters = {}
+        for track in tracks:
+            filename = self.params.name + "_" + "track" + str(track+1) + ".wav"
+            track_writers = [MappedWavWriter(self.projectpath + '/' + str(pattern_nr) + '/' + filename,
+                                             2, engine.sampwidth, self.RATE,
+                                             pattern_frames if pattern_nr < patterns - 1 else
+                                             total_frames - pattern_frames * pattern_nr)
+                             for pattern_nr in range(patterns)]
+            writers += track_writers
+            #Cut at pattern boundaries, the extra seconds end up as tail of the last pattern
+            splitters[track] = SplitSink(track_writers, [pattern_frames] * patterns, 2 * engine.sampwidth)
+        with self.trackSink(splitters) as sink:
+            take = engine.record(sink, total_frames, on_start=self.start_MIDI,
+                                 tail=self.tailDetector(pattern_frames * patterns),
+                                 meter=self.levelMeter(tracks))
+        self.takeStats(take, 'chain', tracks)
+        self.stop_MIDI()
+        self.status("End of Recording")
+        if take.aborted:
+            return None
+        return {writer.filename: writer.frames_written() for writer in writers}
+
+    def cancelRec(self):      
+        self.cancel = 1  
+        if self.session and self.session.engine:
+            self.session.engine.abort_take()
+
+
+class UnitExport:
+    """Runs one ExportEngine per connected unit in parallel, each in its own thread and subfolder"""
+
+    def __init__(self, params, status=print):
+        self.params = params
+        self.status = status
+        self.engines = []
+        self.cancel = 0
+
+    def run(self):
+        """Export all units, returns True if every unit finished"""
+        units = discoverUnits()
+        if not units:
+            self.status("Can't find OP-Z or OP-XY: MIDI Error.")
+            return False
+        self.status("Exporting {} units".format(len(units)))
+        for unit in units:
+            params = replace(self.params, all_units=False, device=unit['type'], midi_port=unit['midi'],
+                             audio_device=unit['audio'], projectpath=os.path.join(self.params.projectpath, unit['name']))
+            self.engines.append(ExportEngine(params, status=lambda msg, name=unit['name']: self.status(name + ": " + msg)))
+        results = [False] * len(self.engines)
+
+        def export(nr):
+            if not self.cancel:
+                results[nr] = self.engines[nr].run()
+
+        threads = [threading.Thread(target=export, args=(nr,), name=unit['name'])
+                   for nr, unit in enumerate(units)]
+        for thread in threads:
+            thread.start()
+        #Wall time is that of the slowest unit
+        for thread in threads:
+            thread.join()
+        failed = [unit['name'] for unit, ok in zip(units, results) if not ok]
+        if failed:
+            self.status("Export failed for " + ", ".join(failed))
+        else:
+            self.status("Exported {} units".format(len(units)))
+        return not failed
+
+    def cancelRec(self):
+        self.cancel = 1
+        for engine in self.engines:
+            engine.cancelRec()
+
+
+def makeExport(params, status=print, meter=None):
+    """The export for a set of parameters, all connected units or just one. Levels are only metered for one unit"""
+    if params.all_units:
+        return UnitExport(params, status)
+    return ExportEngine(params, status, meter)
 
-class OPZDevice(DeviceInterface):
-    """OP-Z specific MIDI implementation"""
-    
-    def get_device_name(self):
-        return "OP-Z"
-    
-    def mute_channel(self, channel, mute_value):
-        """OP-Z uses CC 53 for mute control"""
-        msg = mido.Message('control_change', control=53, channel=channel, value=mute_value)
-        self.outport.send(msg)
-    
-    def start_playback(self):
-        """Standard MIDI start message"""
-        msg = mido.Message('start')
-        self.outport.send(msg)
-    
-    def stop_playback(self):
-        """Standard MIDI stop message"""
-        msg = mido.Message('stop')
-        self.outport.send(msg)
-    
-    def next_pattern(self):
-        """OP-Z uses CC 103 value 16 for next pattern"""
-        msg = mido.Message('control_change', control=103, value=16)
-        self.outport.send(msg)
 
+class UiChannel:
+    """Engine threads post here, the Tk loop picks the updates up at a fixed rate.
 
-class OPXYDevice(DeviceInterface):
-    """OP-XY specific MIDI implementation"""
-    
-    def get_device_name(self):
-        return "OP-XY"
-    
-    def mute_channel(self, channel, mute_value):
-        """OP-XY uses CC 53 for mute control (same as OP-Z)"""
-        msg = mido.Message('control_change', control=53, channel=channel, value=mute_value)
-        self.outport.send(msg)
-    
-    def start_playback(self):
-        """Standard MIDI start message"""
-        msg = mido.Message('start')
-        self.outport.send(msg)
-    
-    def stop_playback(self):
-        """Standard MIDI stop message"""
-        msg = mido.Message('stop')
-        self.outport.send(msg)
-    
-    def next_pattern(self):
-        """OP-XY uses CC 103 for pattern navigation (similar to OP-Z)"""
-        msg = mido.Message('control_change', control=103, value=16)
-        self.outport.send(msg)
+    Tk must only be touched from its own thread. Only the newest value per kind is kept, so a burst of
+    status messages or meter readings costs one redraw.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def post(self, kind, value):
+        with self.lock:
+            self.pending[kind] = value
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+
+def loadTk():
+    """Tk for the window, imported on demand so the command line, batch mode and the
+    post-processing workers run on machines without python3-tk"""
+    import tkinter
+    from tkinter import filedialog, ttk
+    globals().update({name: getattr(tkinter, name) for name in tkinter.__all__})
+    globals().update(fd=filedialog, ttk=ttk)
 
 
 class Midirecorder:
-    def __init__(self):
+    UI_POLL_MS = 50  # how often engine updates are applied to the widgets
+    METER_WIDTH = 360
+    METER_FLOOR = -60.0  # dBFS at the left end of the level meters
 
+    def __init__(self):
+        loadTk()
         self.window = Tk()
         self.window.title('underbridge')
         self.window.resizable(width=False, height=False) #565A5E
         self.window.tk_setPalette(background='#565A5E', foreground='black',activeBackground='#283867', activeForeground='black' )
-        #device_list = []
-        self.op_device = []
-        self.audio_device = None  # Initialize to None for proper detection checking
-        self.loop_time = 0
-        self.inport = 0
-        self.outport = 0
-        self.device_interface = None  # Device abstraction instance
-        self.path = 0
-        self.folder = 0
-        self.pattern_nr = 0
-        self.j = 0       
-        self.addsec = 0
         self.projectpath = 0
-        self.cancel = 0
-        self.RATE = 0
-        self.detected_device_type = None  # Store detected device type
-        self.mute_list =[0] * 14 #Midi mute selection of all 14 necessary channels
-        #modifier_dict = {"mod1": modifier1_va}
+        self.engine = None  # ExportEngine of the running export
+        self.ui = UiChannel()  # status and levels from engine threads
 
         #GUI Main
         self.buttonsize_x = 7
@@ -133,6 +2590,18 @@ class Midirecorder:
         self.modifier4_value = IntVar()
         self.modifier5_value = IntVar()
         self.modifier6_value = IntVar()
+        self.probe_value = IntVar()  # probe every track first and skip the silent ones
+        self.placeholder_value = IntVar()  # write empty files for skipped tracks
+        self.resume_value = IntVar()  # skip takes the checkpoint of an earlier failed export already has
+        self.post_flac_value = IntVar()  # post-processing stages, run while the next take records
+        self.post_normalize_value = IntVar()
+        self.post_dc_value = IntVar()
+        self.post_resample_value = IntVar()
+        self.all_units_value = IntVar()
+        self.verify_value = IntVar()  # check the stems against a full mix take and retake the failing ones
+        self.channel_map_value = StringVar()  # "track:first input,..." for multichannel interfaces
+        self.adaptive_tail_value = IntVar()  # stop once the tail decayed, extra Sec is the maximum
+        self.auto_tempo_value = IntVar()  # measure BPM and pattern length from the device clock
 
         deviceframe = LabelFrame(self.window, text="Device Selection", padx=10, pady=2, fg='white')
         deviceframe.grid(row=0, column=0, padx=2, pady=2)
@@ -141,15 +2610,33 @@ class Midirecorder:
         upperframe.grid(row = 1, column = 0, padx =2, pady =2,)
 
         lowerframe= Frame(self.window,padx= 10, pady =5)
-        lowerframe.grid(row = 3, column = 0, padx =2, pady =2)
+        lowerframe.grid(row = 5, column = 0, padx =2, pady =2)
 
         modifiers = LabelFrame(self.window, text= "Exclude Modifiers",padx= 10, pady =2, fg = 'white')
         modifiers.grid(row = 2, column = 0, padx =2, pady =2)
 
+        options = LabelFrame(self.window, text= "Options",padx= 10, pady =2, fg = 'white')
+        options.grid(row = 3, column = 0, padx =2, pady =2)
+
         footer= Frame(self.window,padx= 15, pady =2)
-        footer. grid(row = 4, column = 0, padx =2, pady =2)
+        footer. grid(row = 6, column = 0, padx =2, pady =2)
 
-        #Get_BPM = Button(upperframe, text="Get BPM",width = self.buttonsize_x, height = self.buttonsize_y, fg = 'lightgrey', command = getBPM)
+        levels = LabelFrame(self.window, text= "Levels",padx= 10, pady =2, fg = 'white')
+        levels.grid(row = 4, column = 0, padx =2, pady =2)
+        self.meter = Canvas(levels, width = self.METER_WIDTH + 30, height = 8 * 12, bg = '#565A5E', highlightthickness = 0)
+        self.meter.grid(row = 0, column = 0)
+        self.meter_bars = []
+        for track in range(8):
+            y = track * 12 + 2
+            self.meter.create_text(12, y + 4, text = str(track + 1), fill = 'white', font = ('Courier', 8))
+            self.meter.create_rectangle(30, y, 30 + self.METER_WIDTH, y + 9, outline = '', fill = 'grey')
+            rms = self.meter.create_rectangle(30, y, 30, y + 9, outline = '', fill = '#0095FF')
+            peak = self.meter.create_line(30, y, 30, y + 9, fill = '#FFCC00', width = 2)
+            self.meter_bars.append((rms, peak, y))
+
+        Get_BPM = Button(upperframe, text="Get BPM",width = self.buttonsize_x, height = self.buttonsize_y, fg = 'white', bg= '#0095FF',
+                         command = lambda:threading.Thread(target = self.getBPM, args=(self.collectParams(),)).start())
+        Get_BPM.grid(row = 0, column = 2, padx =5, pady =0)
         
         # Device selection radio buttons
         device_opz = Radiobutton(deviceframe, text='OP-Z', value=1, variable=self.device_select, 
@@ -160,9 +2647,14 @@ class Midirecorder:
         
         device_opz.grid(row=0, column=0, padx=5, pady=2)
         device_opxy.grid(row=0, column=1, padx=5, pady=2)
+
+        calibrate = Button(deviceframe, text="Calibrate", width=self.buttonsize_x, height=self.buttonsize_y, fg='white', bg='#0095FF',
+                           command=lambda: threading.Thread(target=self.calibrateLatency, args=(self.collectParams(),)).start())
+        calibrate.grid(row=0, column=2, padx=5, pady=2)
         
         Song = Radiobutton(lowerframe, text= 'Project', value = 2 , variable = self.mode_select, width = self.buttonsize_x, height = self.buttonsize_y , indicatoron = 0, bg= '#1b7d24' )
         Pattern = Radiobutton(lowerframe, text= 'Pattern', value = 3 , variable = self.mode_select, width = self.buttonsize_x, height = self.buttonsize_y, indicatoron = 0,bg= '#1b7d24' )
+        Chain = Radiobutton(lowerframe, text= '1-Pass', value = 4 , variable = self.mode_select, width = self.buttonsize_x, height = self.buttonsize_y, indicatoron = 0,bg= '#1b7d24' )
         Pattern.select()
 
         self.bar_input = Scale(upperframe, from_ = 1, to = 9, orient = HORIZONTAL, label="Nr. Bars", sliderlength= 10, length= 75, fg = 'white')
@@ -193,9 +2685,47 @@ class Midirecorder:
         modifier6 = Checkbutton(modifiers,text="Module", variable=self.modifier6_value)
         modifier6.grid(row = 0, column = 5, padx =5, pady =2)
 
+        probe = Checkbutton(options, text="Skip silent tracks", variable=self.probe_value)
+        probe.grid(row = 0, column = 0, padx =5, pady =2)
+
+        placeholder = Checkbutton(options, text="Empty files for skipped", variable=self.placeholder_value)
+        placeholder.grid(row = 0, column = 1, padx =5, pady =2)
+
+        adaptive_tail = Checkbutton(options, text="Adaptive tail", variable=self.adaptive_tail_value)
+        adaptive_tail.grid(row = 0, column = 2, padx =5, pady =2)
+
+        auto_tempo = Checkbutton(options, text="Tempo from clock", variable=self.auto_tempo_value)
+        auto_tempo.grid(row = 0, column = 3, padx =5, pady =2)
+
+        resume = Checkbutton(options, text="Resume", variable=self.resume_value)
+        resume.grid(row = 0, column = 4, padx =5, pady =2)
+
+        post_flac = Checkbutton(options, text="FLAC", variable=self.post_flac_value)
+        post_flac.grid(row = 1, column = 0, padx =5, pady =2)
+
+        post_normalize = Checkbutton(options, text="Normalize", variable=self.post_normalize_value)
+        post_normalize.grid(row = 1, column = 1, padx =5, pady =2)
+
+        post_dc = Checkbutton(options, text="Remove DC", variable=self.post_dc_value)
+        post_dc.grid(row = 1, column = 2, padx =5, pady =2)
+
+        post_resample = Checkbutton(options, text="Resample to 44.1 kHz", variable=self.post_resample_value)
+        post_resample.grid(row = 1, column = 3, padx =5, pady =2)
+
+        channel_map_label = Label(options, text="Channel map", fg = 'white')
+        channel_map_label.grid(row = 2, column = 0, padx =5, pady =2)
+        channel_map = Entry(options, width =20, textvariable=self.channel_map_value, bg= 'lightgrey', relief= FLAT)
+        channel_map.grid(row = 2, column = 1, padx =5, pady =2, columnspan=2, sticky = W)
+
+        all_units = Checkbutton(options, text="All connected units", variable=self.all_units_value)
+        all_units.grid(row = 2, column = 3, padx =5, pady =2)
+
+        verify = Checkbutton(options, text="Verify stems", variable=self.verify_value)
+        verify.grid(row = 3, column = 0, padx =5, pady =2)
+
         set_param = Button(lowerframe, text="Set Prmtr",width = self.buttonsize_x, height = self.buttonsize_y, fg = 'white',bg= '#0095FF', command = self.setParam)
         set_path = Button(lowerframe, text="Directory",width = self.buttonsize_x, height = self.buttonsize_y,fg = 'white',bg= '#0095FF', command = self.setPath)
-        start_recording = Button(lowerframe, text="RECORD",width = self.buttonsize_x, height = self.buttonsize_y,fg = 'white', bg = '#FF2200', command = lambda:threading.Thread(target = self.sequenceMaster).start())
+        start_recording = Button(lowerframe, text="RECORD",width = self.buttonsize_x, height = self.buttonsize_y,fg = 'white', bg = '#FF2200', command = self.startRecording)
 
         tutorial = Label(footer,text="Enter Parameter, then press set Param, choose directory and start recording", height = 2, bg ='grey',fg= 'white', relief = FLAT)
         display = Label(lowerframe,textvariable= self.displaymsg,width = 60, height = self.buttonsize_y -1, bg ='lightgrey', relief = FLAT)
@@ -205,9 +2735,13 @@ class Midirecorder:
 
         donate = Label(footer, text= "donate <3 @ https://link.raise-uav.com", height = 1)
         donate.grid(row = 3, column = 4, padx =2, pady =10, columnspan=2)
+
+        stats = Button(footer, text="Stats", width = self.buttonsize_x, fg = 'white', bg= '#0095FF', command = self.showStats)
+        stats.grid(row = 3, column = 0, padx =5, pady =10)
        
         Song.grid(row = 0, column = 1, padx =5, pady =2)
         Pattern.grid(row = 0, column = 2, padx =5, pady =2)
+        Chain.grid(row = 0, column = 0, padx =5, pady =2)
 
         self.name_input.grid(row = 0, column = 0, padx =5, pady =0)
         self.bpm_input.grid(row = 0, column = 1, padx =5, pady =0)
@@ -222,335 +2756,263 @@ class Midirecorder:
         tutorial.grid(row = 1, column = 0, padx =5, pady =5, columnspan=5)
         display.grid(row = 1, column = 0, padx =2, pady =10, columnspan= 7)
 
+        #Look for the device once the window is up, MIDI and audio backends load in the background
+        self.window.after(0, lambda: threading.Thread(target=self.discoverDevice, args=(self.collectParams(),),
+                                                      daemon=True).start())
+        self.window.after(self.UI_POLL_MS, self.pollUi)
         self.window.mainloop()
 
-    def getMIDIDevice(self):   
-        #global device_list
-        #global op_device
-        device_list = mido.get_output_names()
-        print (device_list)
-        
-        # Try to detect based on user selection first, then auto-detect
-        selected_device = self.device_select.get()
-        device_found = False
-        
-        if selected_device == 1:  # User selected OP-Z
-            try: 
-                self.op_device = list(filter(lambda x: 'OP-Z' in x, device_list))        
-                self.op_device = self.op_device[0]
-                self.detected_device_type = "OP-Z"
-                self.displaymsg.set("OP-Z found")
-                device_found = True
-            except:
-                pass
-        elif selected_device == 2:  # User selected OP-XY
-            try:
-                self.op_device = list(filter(lambda x: 'OP-XY' in x, device_list))
-                self.op_device = self.op_device[0]
-                self.detected_device_type = "OP-XY"
-                self.displaymsg.set("OP-XY found")
-                device_found = True
-            except:
-                pass
-        
-        # If selected device not found, try auto-detection
-        if not device_found:
-            try: 
-                self.op_device = list(filter(lambda x: 'OP-Z' in x, device_list))        
-                self.op_device = self.op_device[0]
-                self.detected_device_type = "OP-Z"
-                self.displaymsg.set("OP-Z found (auto-detected)")
-                device_found = True
-            except:
-                pass
-        
-        if not device_found:
-            try:
-                self.op_device = list(filter(lambda x: 'OP-XY' in x, device_list))
-                self.op_device = self.op_device[0]
-                self.detected_device_type = "OP-XY"
-                self.displaymsg.set("OP-XY found (auto-detected)")
-                device_found = True
-            except:
-                pass
-        
-        if not device_found:
-            self.displaymsg.set("Can't find OP-Z or OP-XY: MIDI Error.")
-
-    def getAudioDevice(self):
-        #global audio_device
-        #global RATE
-        p = pyaudio.PyAudio()
+    def collectParams(self):
+        #Everything the engine needs, read from the widgets
         try:
-            info = p.get_host_api_info_by_index(0)
-            numdevices = info.get('deviceCount')
-            for i in range(0, numdevices):
-                if (p.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
-                    print("Input Device id ", i, " - ", p.get_device_info_by_host_api_device_index(0, i).get('name'))
-            
-            # Search for the device based on detected type or user selection
-            device_search_name = None
-            if self.detected_device_type:
-                device_search_name = self.detected_device_type
-            elif self.device_select.get() == 1:
-                device_search_name = "OP-Z"
-            elif self.device_select.get() == 2:
-                device_search_name = "OP-XY"
-            
-            for i in range(0, numdevices):
-                device_name = p.get_device_info_by_host_api_device_index(0, i).get('name')
-                max_channels = p.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')
-                
-                if device_search_name and device_search_name in device_name and max_channels > 0:
-                    self.audio_device = i
-                    print(f"Detected {device_search_name} audio at Index:", self.audio_device, device_name)
-                    break
-            
-            if not hasattr(self, 'audio_device') or self.audio_device is None:
-                self.displaymsg.set(f"{device_search_name or 'Device'} Audio Device not found.")
-        except Exception as e:
-            self.displaymsg.set(f"Audio Device Error: {str(e)}")
-
-        #devinfo = p.get_device_info_by_index(self.audio_device)  
-        try:         
-            devinfo = p.get_device_info_by_index(self.audio_device)  
-            test = p.is_format_supported(48000, input_device=devinfo['index'], input_channels=devinfo['maxInputChannels'],input_format=pyaudio.paInt16)
-            self.RATE = 48000
-            print("48kHz")
-        except:
-            self.RATE = 44100
-            print("44100kHz compatibility mode")    
+            bpm = float(self.bpm_input.get())
+        except ValueError:
+            bpm = 0.0
+        try:
+            channel_map = parseChannelMap(self.channel_map_value.get()) or None
+        except ValueError:
+            channel_map = [[0, 0]]  # rejected by validate()
+        modifiers = [self.modifier1_value, self.modifier2_value, self.modifier3_value,
+                     self.modifier4_value, self.modifier5_value, self.modifier6_value]
+        return ExportParams(name=self.name_input.get(),
+                            projectpath=self.projectpath or "",
+                            device="OP-XY" if self.device_select.get() == 2 else "OP-Z",
+                            mode={2: 'project', 3: 'pattern', 4: 'chain'}[self.mode_select.get()],
+                            bpm=bpm,
+                            bars=self.bar_input.get(),
+                            patterns=self.patterns_input.get(),
+                            extra_seconds=self.add_sec.get(),
+                            exclude=[modifier.get() for modifier in modifiers],
+                            probe=bool(self.probe_value.get()),
+                            placeholders=bool(self.placeholder_value.get()),
+                            adaptive_tail=bool(self.adaptive_tail_value.get()),
+                            auto_tempo=bool(self.auto_tempo_value.get()),
+                            resume=bool(self.resume_value.get()),
+                            post_flac=bool(self.post_flac_value.get()),
+                            post_normalize='peak' if self.post_normalize_value.get() else None,
+                            post_dc=bool(self.post_dc_value.get()),
+                            post_rate=44100 if self.post_resample_value.get() else None,
+                            channel_map=channel_map,
+                            all_units=bool(self.all_units_value.get()),
+                            verify=bool(self.verify_value.get()))
 
-    def getBPM(self):        
-        inport= mido.open_input(self.op_device)
-        msg = inport.poll(self)
-        #print(msg)
+    def getBPM(self, params):
+        #Worker thread, the params were read on the Tk thread and the BPM goes back through the channel
+        bpm = ExportEngine(params, status=self.postStatus).getBPM()
+        if bpm is not None:
+            self.ui.post('bpm', bpm)
+
+    def calibrateLatency(self, params):
+        ExportEngine(params, status=self.postStatus).calibrateLatency()
 
     def setLoop(self):       
-        try:        
-            bpm = self.bpm_input.get()
-            bar = self.bar_input.get()
-            addsec = self.add_sec.get()
-            self.loop_time = (240 / int(bpm) * int(bar)) + int(addsec)
-            print("Loop time set!", self.loop_time)
+        params = self.collectParams()
+        if params.bpm > 0:
+            print("Loop time set!", params.loop_time())
             self.displaymsg.set("BPM Set!")
-        except:
+        else:
             self.displaymsg.set("Please enter accurate BPM.")
-        #return self.loop_time
 
     def setParam(self):
         self.setLoop()
-        #mode = mode_select.get()
-        #if mode == 2:
-        #    projnr = project_input.get()
-        #    setProject(projnr)
 
-    def openMidi(self):    
-        #global outport  
-        #global op_device
-        self.outport= mido.open_output(self.op_device)    
-        
-        # Initialize device interface based on detected device type
-        if self.detected_device_type == "OP-Z":
-            self.device_interface = OPZDevice(self.outport)
-        elif self.detected_device_type == "OP-XY":
-            self.device_interface = OPXYDevice(self.outport)
-        else:
-            # Default to OP-Z for backward compatibility
-            self.device_interface = OPZDevice(self.outport)
-        
-        print(f"Initialized device interface: {self.device_interface.get_device_name()}")
-        #displaymsg.set("OP-Z MIDI not connected :(")
-        #print(self.outport) 
+    def setPath(self):
+        #global path
+        folder = self.name_input.get()
+        path = fd.askdirectory()    
+        self.displaymsg.set("Directory set!")
+        self.makeDir(path,folder)
 
-    def setProject(self,projnr):
-        msg= mido.Message('program_change',song= self.projnr, program = 1)
-        self.outport.send(msg)
+    def makeDir(self,path,folder):
+        self.projectpath = path + '/' + folder
+        #Resume picks the same name and directory again, so an existing folder is fine
+        try:    
+            os.makedirs(self.projectpath, exist_ok=True)
+        except OSError as e:
+            self.displaymsg.set("Directory Error: {}. Please enter different Name.".format(e))
 
-    def muteAll(self):        
-        checkbutton_name = 0    
-        #print(self.mute_list)
-        
-        for j in range (0,8):
-            self.mute_list[j] = 1     
-        
-        for i in range (1,7):
-            checkbutton_name = 'self.modifier{}_value'.format(i)     #checkbutton 1- 6         
-            self.mute_list[i+7] = eval(checkbutton_name).get()       #9th position in mute list  
+    def startRecording(self):
+        params = self.collectParams()
+        try:
+            params.validate()
+        except ValueError as e:
+            self.displaymsg.set("Can't start: {}".format(e))
+            return
+        self.engine = makeExport(params, status=self.postStatus, meter=self.postLevels)
+        threading.Thread(target=self.engine.run).start()
 
-        for k in range (0,14):
-            if self.device_interface:
-                self.device_interface.mute_channel(k, self.mute_list[k])
-            else:
-                # Fallback to direct message if device interface not initialized
-                msg = mido.Message('control_change',control= 53, channel= k, value= self.mute_list[k])
-                self.outport.send(msg)
-        #print("Muted Channels",self.mute_list)
+    def cancelRec(self):      
+        if self.engine:
+            self.engine.cancelRec()
 
-    def setSolo(self,chn):        
-        if self.device_interface:
-            self.device_interface.mute_channel(chn, 0)
-        else:
-            msg = mido.Message('control_change',control= 53, channel= chn, value=0)        
-            self.outport.send(msg)
-        
-    def start_MIDI(self):        
-        if self.device_interface:
-            self.device_interface.start_playback()
-        else:
-            msg = mido.Message('start')
-            self.outport.send(msg)
-        self.displaymsg.set("Playback started")
-        #print("midi")
+    def postStatus(self, msg):
+        self.ui.post('status', msg)
 
-    def stop_MIDI(self):        
-        if self.device_interface:
-            self.device_interface.stop_playback()
-        else:
-            msg = mido.Message('stop')
-            self.outport.send(msg)
-        self.displaymsg.set("Playback stopped")
+    def postLevels(self, levels):
+        self.ui.post('levels', levels)
 
-    def unmuteAll(self):        
-        for i in range (0,15):
-            if self.device_interface:
-                self.device_interface.mute_channel(i, 0)
-            else:
-                msg = mido.Message('control_change',control= 53, channel= i, value=0)
-                self.outport.send(msg)        
+    def pollUi(self):
+        #Runs on the Tk thread, applies whatever the engine posted since the last poll
+        updates = self.ui.take()
+        if 'status' in updates:
+            self.displaymsg.set(updates['status'])
+        if 'levels' in updates:
+            self.drawLevels(updates['levels'])
+        if 'bpm' in updates:
+            self.bpm_input.delete(0, END)
+            self.bpm_input.insert(0, "{:.1f}".format(updates['bpm']))
+        self.window.after(self.UI_POLL_MS, self.pollUi)
 
-    def nextPattern(self):        
-        if self.device_interface:
-            self.device_interface.next_pattern()
-        else:
-            msg = mido.Message('control_change', control = 103, value = 16)
-            self.outport.send(msg)
-        self.displaymsg.set("Next Pattern")
+    def drawLevels(self, levels):
+        #RMS as bar, peak as line, tracks that aren't in the take are cleared
+        def x(dbfs):
+            return 30 + self.METER_WIDTH * min(max(dbfs - self.METER_FLOOR, 0) / -self.METER_FLOOR, 1)
 
-    def nextSong(self):
-        pass
+        for track, (rms_bar, peak_line, y) in enumerate(self.meter_bars):
+            peak, rms = levels.get(track, (float('-inf'), float('-inf')))
+            self.meter.coords(rms_bar, 30, y, x(rms), y + 9)
+            self.meter.coords(peak_line, x(peak), y, x(peak), y + 9)
+            self.meter.itemconfigure(peak_line, fill = '#FF2200' if peak >= -0.1 else '#FFCC00')
 
-    def closeMidi(self):           
-        self.outport.close()    
-        self.displaymsg.set("MIDI closed")     
+    def discoverDevice(self, params):
+        #Caches the device profile, so the first RECORD skips the full probe
+        try:
+            ExportEngine(params, status=self.postStatus).discoverDevice()
+        except Exception as e:
+            print("Device discovery failed:", repr(e))
 
-    def setPath(self):
-        #global path
-        folder = self.name_input.get()
-        path = fd.askdirectory()    
-        self.displaymsg.set("Directory set!")
-        self.makeDir(path,folder)
+    def showStats(self):
+        #Live capture figures of the running export, refreshed twice a second
+        view = Toplevel(self.window)
+        view.title("Underbridge stats")
+        text = StringVar()
+        Label(view, textvariable=text, justify=LEFT, font=('Courier', 10), padx=10, pady=10).pack()
 
-    def makeDir(self,path,folder):
-        #global folder
-        #global projectpath
-        #folder = name_input.get()
-        self.projectpath = path + '/' + folder
-        try:    
-            os.mkdir(self.projectpath)   
-        except:
-            self.displaymsg.set("Directory Error. Please enter different Name.")
+        def refresh():
+            if not view.winfo_exists():
+                return
+            engines = getattr(self.engine, 'engines', [self.engine]) if self.engine else []
+            text.set("\n\n".join(engine.stats.summary() for engine in engines) or "No export running")
+            view.after(500, refresh)
 
-    def makeDirNr(self, pattern_nr):    
-        #global projectpath    
-        #Pfad wird addiert deswegen zusätzliche verzeichnisse
-        #projectpath = projectpath + '/' + str(pattern_nr)
+        refresh()
+
+
+def paramsFromJob(job, defaults=None):
+    """ExportParams from a job file entry. "output" is the directory the project folder is created in"""
+    values = dict(defaults or {})
+    values.update(job)
+    values.pop('prompt', None)
+    output = values.pop('output', None)
+    if 'exclude' in values and values['exclude'] and isinstance(values['exclude'][0], str):
+        unknown = set(values['exclude']) - set(MODIFIERS)
+        if unknown:
+            raise ValueError("unknown modifiers: " + ", ".join(sorted(unknown)))
+        values['exclude'] = [int(name in values['exclude']) for name in MODIFIERS]
+    if isinstance(values.get('channel_map'), str):
+        values['channel_map'] = parseChannelMap(values['channel_map']) or None
+    params = ExportParams(**values)
+    if not params.projectpath and output:
+        params.projectpath = os.path.join(output, params.name)
+    return params
+
+
+def runBatch(jobfile):
+    """Export the projects of a job file one after another, returns the number of failed jobs"""
+    with open(jobfile) as f:
+        jobs = json.load(f)
+    defaults = {}
+    if isinstance(jobs, dict):
+        defaults = jobs.get('defaults', {})
+        jobs = jobs['jobs']
+    failed = 0
+    for index, job in enumerate(jobs):
+        #A misspelled key or a bad value only costs this job
         try:
-            os.mkdir(self.projectpath + '/' + str(pattern_nr)) 
-        except:
-            self.displaymsg.set("Directory Error")
-        #print(projectpath)
+            params = paramsFromJob(job, defaults)
+            params.validate()
+        except (TypeError, ValueError) as e:
+            print("Skipping job {}/{}: {}".format(index + 1, len(jobs), e))
+            failed += 1
+            continue
+        print("Job {}/{}: {}".format(index + 1, len(jobs), params.name))
+        prompt = job.get('prompt', defaults.get('prompt'))
+        if prompt:
+            #e.g. "Load project 3 on the OP-Z", skipped when nobody is at the keyboard
+            if sys.stdin.isatty():
+                input(prompt + " - press Enter to continue")
+            else:
+                print(prompt)
+        if not makeExport(params).run():
+            failed += 1
+    return failed
 
-    def start_Rec(self):
-        #print("record")
-        self.displaymsg.set("Recording...")
-        CHUNK = 128
-        FORMAT = pyaudio.paInt16
-        CHANNELS = 2
-        
-        RECORD_SECONDS= self.loop_time
-        #print("record")
-        WAVE_OUTPUT_FILENAME =  self.name_input.get() + "_" + "track" + str(self.j+1) + ".wav"       
-        #print(WAVE_OUTPUT_FILENAME)
-        p = pyaudio.PyAudio()   
-        stream = p.open(format=FORMAT,
-                        channels=CHANNELS,
-                        rate=self.RATE,
-                        input=True,
-                        input_device_index= self.audio_device,
-                        frames_per_buffer=CHUNK                        
-                        )
 
-        #print("* recording")
-        
-        frames = []
-        self.start_MIDI()
-        for i in range(0, int(self.RATE / CHUNK * RECORD_SECONDS)):
-            data = stream.read(CHUNK)
-            frames.append(data)
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='underbridge', description="OP-Z and OP-XY multitrack exporter. "
+                                     "Without a command the GUI is started.")
+    commands = parser.add_subparsers(dest='command')
 
-        #print("Done recording")
+    export = commands.add_parser('export', help="export one project or pattern without the GUI")
+    export.add_argument('--name', required=True, help="project name, used for the folder and file names")
+    export.add_argument('--output', required=True, help="directory the project folder is created in")
+    export.add_argument('--device', choices=("OP-Z", "OP-XY"), default="OP-Z")
+    export.add_argument('--mode', choices=MODES, default="pattern")
+    export.add_argument('--bpm', type=float, default=0.0)
+    export.add_argument('--bars', type=int, default=1)
+    export.add_argument('--patterns', type=int, default=16)
+    export.add_argument('--extra-seconds', type=int, default=0)
+    export.add_argument('--exclude', default="", help="modifier tracks to mute: " + ",".join(MODIFIERS))
+    export.add_argument('--probe', action='store_true', help="skip silent tracks")
+    export.add_argument('--placeholders', action='store_true', help="write empty files for skipped tracks")
+    export.add_argument('--adaptive-tail', action='store_true')
+    export.add_argument('--auto-tempo', action='store_true', help="tempo and pattern length from MIDI clock")
+    export.add_argument('--resume', action='store_true')
+    export.add_argument('--flac', action='store_true')
+    export.add_argument('--normalize', choices=('peak', 'rms'))
+    export.add_argument('--remove-dc', action='store_true')
+    export.add_argument('--resample', type=int, help="target sample rate")
+    export.add_argument('--channel-map', default="",
+                        help="track:first input channel pairs for multichannel interfaces, e.g. 1:1,2:3,3:5")
+    export.add_argument('--reconnect-timeout', type=float, default=600.0,
+                        help="seconds to wait for a unit that dropped off USB, 0 to stop the export instead")
+    export.add_argument('--all-units', action='store_true',
+                        help="export every connected unit in parallel into a subfolder per unit")
+    export.add_argument('--verify', action='store_true',
+                        help="record a full mix per pattern, check the stems add up to it and retake the ones that don't")
+    export.add_argument('--verify-tolerance', type=float, default=-20.0,
+                        help="residual against the full mix in dB that still passes")
 
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-        if self.mode_select.get() == 2:
-            wf = wave.open(self.projectpath + '/' + str(self.pattern_nr) + '/' + WAVE_OUTPUT_FILENAME, 'wb')
-        else:
-            wf = wave.open(self.projectpath + '/' + WAVE_OUTPUT_FILENAME, 'wb')
-
-        wf.setnchannels(CHANNELS)
-        wf.setsampwidth(p.get_sample_size(FORMAT))
-        wf.setframerate(self.RATE)
-        wf.writeframes(b''.join(frames))
-        wf.close()
-        self.j = self.j + 1
-        if self.j == 8:
-            self.j= 0
-        self.displaymsg.set("End of Recording")
+    batch = commands.add_parser('batch', help="export all projects listed in a JSON job file")
+    batch.add_argument('jobfile')
 
-    def sequenceMaster(self):       
-        self.cancel = 0
-        self.getMIDIDevice()
-        time.sleep(1)
-        self.getAudioDevice()
-        self.displaymsg.set("Sequence started")
-        try:        
-            self.openMidi()                            
-            if self.mode_select.get() == 2:
-                self.makeDirNr(self.pattern_nr)            
+    args = parser.parse_args(argv)
+    if args.command is None:
+        Midirecorder()
+        return 0
+    if args.command == 'batch':
+        return 1 if runBatch(args.jobfile) else 0
 
-            for i in range (0,8): 
-                pattern_limit = self.patterns_input.get() 
-                if self.cancel == 1 or self.pattern_nr  == pattern_limit:
-                    break
-                #print("sequence started",i)       
-                self.muteAll()                
-                time.sleep(0.1)
-                self.setSolo(i)
-                #starting Midi during wave record for timing                     
-                self.start_Rec()               
-                self.stop_MIDI()
-                time.sleep(1)
-                self.unmuteAll()
-                time.sleep(1)                
-                mode = self.mode_select.get()                
-                
-                if i == 7 and mode == 2: 
-                    #print(mode_select)            
-                    time.sleep(5)
-                    self.nextPattern()
-                    self.pattern_nr += 1
-                    if self.pattern_nr == 15 :
-                        self.pattern_nr = 0
-                    self.sequenceMaster()
-        except:
-            self.displaymsg.set("OP-Z Sequence error try restarting the OP-Z or press CANCEL Button")
+    exclude = [name for name in args.exclude.split(',') if name]
+    try:
+        #Unknown modifiers and a malformed channel map are reported like the other bad options
+        params = paramsFromJob({'name': args.name, 'output': args.output, 'device': args.device, 'mode': args.mode,
+                                'bpm': args.bpm, 'bars': args.bars, 'patterns': args.patterns,
+                                'extra_seconds': args.extra_seconds, 'exclude': exclude or [0] * len(MODIFIERS),
+                                'probe': args.probe, 'placeholders': args.placeholders,
+                                'adaptive_tail': args.adaptive_tail, 'auto_tempo': args.auto_tempo,
+                                'resume': args.resume, 'post_flac': args.flac, 'post_normalize': args.normalize,
+                                'post_dc': args.remove_dc, 'post_rate': args.resample,
+                                'channel_map': args.channel_map, 'all_units': args.all_units,
+                                'reconnect_timeout': args.reconnect_timeout,
+                                'verify': args.verify, 'verify_tolerance': args.verify_tolerance})
+        params.validate()
+    except ValueError as e:
+        parser.error(str(e))
+    return 0 if makeExport(params).run() else 1
 
-    def cancelRec(self):      
-        self.j = 0
-        self.cancel = 1  
-        self.closeMidi()
 
-    
-underbridge = Midirecorder()
\ No newline at end of file
+if __name__ == '__main__':
+    # Post-processing workers re-import this file, the window must only open in the main process
+    multiprocessing.freeze_support()
+    sys.exit(main())
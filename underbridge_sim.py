@@ -0,0 +1,440 @@
+# Underbridge simulated OP-Z and audio interface, for benchmarks without hardware
+# Copyright 2022 Thomas Herrmann Email: herrmann@raise-uav.com
+#
+#   python underbridge_sim.py                        pattern and project mode at 48 kHz
+#   python underbridge_sim.py --rate 44100 --jitter 0.5 --overflows 0.001 --json bench.json
+
+import sys
+import os
+import time
+import threading
+import tempfile
+import tracemalloc
+import argparse
+import json
+import numpy as np
+
+PA_INT16 = 8
+PA_INPUT_UNDERFLOW = 1
+PA_INPUT_OVERFLOW = 2
+
+
+class SimMessage:
+    """Just enough of mido.Message for the messages underbridge sends and receives"""
+
+    DEFAULTS = {'channel': 0, 'control': 0, 'value': 0, 'pos': 0, 'program': 0}
+
+    def __init__(self, type, **kwargs):
+        self.type = type
+        self.__dict__.update(self.DEFAULTS)
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        fields = ' '.join('{}={}'.format(k, v) for k, v in self.__dict__.items() if k != 'type')
+        return '<SimMessage {} {}>'.format(self.type, fields)
+
+
+class SimDevice:
+    """An OP-Z that plays a deterministic noise burst on every beat of each track.
+
+    Reacts to CC 53 mutes, CC 103 next pattern, start, stop and song position 0, echoes what it
+    receives and sends 24 ppq clock with a song position 0 at every loop point while playing.
+    """
+
+    def __init__(self, device_type="OP-Z", rate=48000, bpm=120.0, bars=1, patterns=4, channels=2,
+                 start_latency=0.005, jitter=0.0, overflow_rate=0.0, chain=False, seed=0):
+        self.device_type = device_type
+        self.name = device_type + " (simulated)"
+        self.rate = rate
+        self.bpm = bpm
+        self.bars = bars
+        self.patterns = patterns
+        self.channels = channels
+        self.start_latency = start_latency  # MIDI start to first sample
+        self.jitter = jitter  # standard deviation of the ADC timestamps in seconds
+        self.overflow_rate = overflow_rate  # probability that a block is dropped with an overflow flag
+        self.chain = chain  # play through all patterns instead of looping the current one
+        self.seed = seed
+        self.connected = True
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.mutes = [0] * 14
+        self.dropped_mutes = {}  # channel -> mute CCs still to be ignored
+        self.pattern = 0
+        self.playing = False
+        self.start_time = None
+        self.clock_thread = None
+        self.beat_frames = int(round(rate * 60.0 / bpm))
+        self.pattern_frames = self.beat_frames * 4 * bars
+        envelope = np.exp(-np.arange(self.beat_frames) / (0.02 * rate))
+        # bursts[pattern, track] is one beat, noise correlates sharply so alignment can be measured
+        rng = np.random.default_rng(seed)
+        self.bursts = (rng.standard_normal((patterns, 8, self.beat_frames)) * envelope * 4000).astype(np.float32)
+
+    def unplug(self, seconds):
+        """Drop off the bus like a bumped USB cable and come back after seconds"""
+        with self.lock:
+            self.connected = False
+            self.playing = False
+            self.listeners = []
+        threading.Timer(seconds, self.plug).start()
+
+    def plug(self):
+        with self.lock:
+            self.connected = True
+
+    def drop_mute(self, channel, count=1):
+        """Ignore the next count mute CCs for channel, the track keeps playing into other stems"""
+        with self.lock:
+            self.dropped_mutes[channel] = count
+
+    def add_listener(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+    def emit(self, msg):
+        with self.lock:
+            listeners = list(self.listeners)
+        for callback in listeners:
+            callback(msg)
+
+    def receive(self, msg):
+        """A message from the host"""
+        if not self.connected:
+            raise IOError("MIDI port is gone")
+        with self.lock:
+            if msg.type == 'control_change' and msg.control == 53 and msg.channel < len(self.mutes):
+                if msg.value and self.dropped_mutes.get(msg.channel):
+                    self.dropped_mutes[msg.channel] -= 1
+                else:
+                    self.mutes[msg.channel] = msg.value
+            elif msg.type == 'control_change' and msg.control == 103 and msg.value == 16:
+                self.pattern = (self.pattern + 1) % self.patterns
+            elif msg.type == 'start':
+                self.playing = True
+                self.start_time = time.monotonic() + self.start_latency
+                self.clock_thread = threading.Thread(target=self.clock, args=(self.start_time,), daemon=True)
+                self.clock_thread.start()
+            elif msg.type == 'stop':
+                self.playing = False
+            elif msg.type == 'songpos' and msg.pos == 0 and self.chain:
+                self.pattern = 0
+        self.emit(msg)
+
+    def clock(self, start_time):
+        tick = 60.0 / self.bpm / 24
+        loop_ticks = 96 * self.bars
+        k = 0
+        while self.playing and self.start_time == start_time:
+            delay = start_time + k * tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if k and k % loop_ticks == 0 and not self.chain:
+                self.emit(SimMessage('songpos', pos=0))
+            self.emit(SimMessage('clock'))
+            k += 1
+
+    def render(self, block_time, n_frames):
+        """Interleaved int16 block of n_frames starting at stream time block_time"""
+        out = np.zeros((n_frames, self.channels), dtype=np.int16)
+        with self.lock:
+            if not self.playing:
+                return out
+            first = int(round((block_time - self.start_time) * self.rate))
+            pattern = self.pattern
+            mutes = list(self.mutes)
+        position = first + np.arange(n_frames)
+        playing = position >= 0
+        if not playing.any():
+            return out
+        position = position[playing]
+        offset = position % self.beat_frames
+        patterns = (pattern + position // self.pattern_frames) % self.patterns if self.chain else pattern
+        mix = np.zeros(position.size, dtype=np.float32)
+        for track in range(8):
+            if not mutes[track]:
+                mix += self.bursts[patterns, track, offset]
+        mix = np.clip(mix, -32768, 32767).astype(np.int16)
+        out[playing] = mix[:, None]
+        return out
+
+    def reference(self, track, pattern, n_frames):
+        """What a stem of track should contain from the downbeat of pattern on"""
+        offset = np.arange(n_frames) % self.beat_frames
+        return self.bursts[pattern, track, offset]
+
+
+class SimStream:
+    """PyAudio callback stream that feeds SimDevice blocks at the sample rate in real time"""
+
+    def __init__(self, device, rate, channels, frames_per_buffer, stream_callback):
+        self.device = device
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.callback = stream_callback
+        self.rng = np.random.default_rng(device.seed + 1)
+        self.active = True
+        self.opened = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        n = self.frames_per_buffer
+        k = 0
+        flags = 0
+        while self.active:
+            if not self.device.connected:
+                # PortAudio stops calling back when the device is gone
+                self.active = False
+                return
+            block_time = self.opened + k * n / self.rate
+            delay = block_time + n / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            k += 1
+            data = self.device.render(block_time, n)
+            if self.channels != self.device.channels:
+                data = np.tile(data[:, :2], (1, self.channels // 2))
+            if self.device.overflow_rate and self.rng.random() < self.device.overflow_rate:
+                # The block is lost, the next one reports the overflow
+                flags |= PA_INPUT_OVERFLOW
+                continue
+            adc_time = block_time + (self.rng.normal(0, self.device.jitter) if self.device.jitter else 0.0)
+            self.callback(data.tobytes(), n, {'input_buffer_adc_time': adc_time,
+                                              'current_time': time.monotonic()}, flags)
+            flags = 0
+
+    def get_time(self):
+        return time.monotonic()
+
+    def get_input_latency(self):
+        return 0.0
+
+    def is_active(self):
+        return self.active
+
+    def stop_stream(self):
+        self.active = False
+        self.thread.join()
+
+    def close(self):
+        self.active = False
+
+
+class SimPyAudio:
+    """pyaudio.PyAudio with the simulated device as its only input"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def device_info(self):
+        return {'index': 0, 'name': self.device.name, 'maxInputChannels': self.device.channels,
+                'defaultSampleRate': float(self.device.rate)}
+
+    def get_host_api_info_by_index(self, index):
+        return {'deviceCount': 1}
+
+    def get_device_info_by_host_api_device_index(self, api, index):
+        return self.device_info()
+
+    def get_device_info_by_index(self, index):
+        return self.device_info()
+
+    def is_format_supported(self, rate, **kwargs):
+        if rate != self.device.rate:
+            raise ValueError("Invalid sample rate")
+        return True
+
+    def get_sample_size(self, sample_format):
+        return 2
+
+    def open(self, rate, channels, frames_per_buffer, stream_callback, **kwargs):
+        if not self.device.connected:
+            raise IOError("Device unavailable")
+        return SimStream(self.device, rate, channels, frames_per_buffer, stream_callback)
+
+    def terminate(self):
+        pass
+
+
+class SimPyAudioModule:
+    """Stands in for the pyaudio module"""
+
+    paInt16 = PA_INT16
+    paContinue = 0
+    paInputUnderflow = PA_INPUT_UNDERFLOW
+    paInputOverflow = PA_INPUT_OVERFLOW
+
+    def __init__(self, device):
+        self.device = device
+
+    def PyAudio(self):
+        return SimPyAudio(self.device)
+
+
+class SimOutput:
+    def __init__(self, device):
+        self.device = device
+
+    def send(self, msg):
+        self.device.receive(msg)
+
+    def close(self):
+        pass
+
+
+class SimInput:
+    def __init__(self, device, callback):
+        self.device = device
+        self.callback = callback
+        device.add_listener(callback)
+
+    def close(self):
+        self.device.remove_listener(self.callback)
+
+
+class SimMido:
+    """Stands in for the mido module, the simulated device is the only port"""
+
+    Message = SimMessage
+
+    def __init__(self, device):
+        self.device = device
+
+    def get_output_names(self):
+        return [self.device.name] if self.device.connected else []
+
+    def get_input_names(self):
+        return [self.device.name] if self.device.connected else []
+
+    def open_output(self, name):
+        return SimOutput(self.device)
+
+    def open_input(self, name, callback=None):
+        return SimInput(self.device, callback)
+
+
+def install(device):
+    """Point underbridge's MIDI and audio backends at device"""
+    import underbridge
+    underbridge.mido = SimMido(device)
+    underbridge.pyaudio = SimPyAudioModule(device)
+    return underbridge
+
+
+def alignmentError(stem, reference, rate, max_lag=0.02):
+    """Offset of the stem against the reference in seconds, positive if the stem starts late"""
+    lag_frames = int(rate * max_lag)
+    length = min(len(reference) - 2 * lag_frames, len(stem), int(rate * 0.25))
+    if length <= 0:
+        return None
+    signal = stem[:length].astype(np.float32)
+    if not signal.any():
+        return None
+    # Reference shifted by -max_lag..max_lag against the start of the stem
+    scores = np.correlate(np.concatenate([np.zeros(lag_frames, np.float32), reference[:length + lag_frames]]),
+                          signal, 'valid')
+    return (int(np.argmax(scores)) - lag_frames) / rate
+
+
+def benchmarkMode(mode, rate=48000, bpm=240.0, bars=1, patterns=2, jitter=0.0, overflow_rate=0.0,
+                  frames_per_buffer=128, unplug=None, verify=False, drop_mute=None):
+    """Run one export against a simulated device, returns its figures"""
+    device = SimDevice(rate=rate, bpm=bpm, bars=bars, patterns=patterns, jitter=jitter,
+                       overflow_rate=overflow_rate, chain=mode == 'chain')
+    underbridge = install(device)
+    with tempfile.TemporaryDirectory() as folder:
+        # Keep the device profile of the simulated unit out of the real settings
+        underbridge.SETTINGS_PATH = os.path.join(folder, 'settings.json')
+        params = underbridge.ExportParams(name='bench', projectpath=os.path.join(folder, mode), device="OP-Z",
+                                          mode=mode, bpm=bpm, bars=bars, patterns=patterns,
+                                          frames_per_buffer=frames_per_buffer, verify=verify)
+        params.validate()
+        # As if calibrated, so the alignment error shows what the pipeline adds
+        underbridge.updateSettings('start_offset', device.device_type, device.start_latency)
+        engine = underbridge.ExportEngine(params, status=lambda msg: None)
+        if unplug is not None:
+            # Cable bump: gone for 2 seconds, unplug seconds into the export
+            threading.Timer(unplug, device.unplug, args=(2.0,)).start()
+        if drop_mute is not None:
+            device.drop_mute(drop_mute)
+        tracemalloc.start()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        finished = engine.run()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        errors = []
+        for pattern in range(patterns if mode != 'pattern' else 1):
+            for track in range(8):
+                name = 'bench_track{}.wav'.format(track + 1)
+                path = os.path.join(params.projectpath, name) if mode == 'pattern' else \
+                    os.path.join(params.projectpath, str(pattern), name)
+                if not os.path.exists(path):
+                    continue
+                samples, stem_rate = underbridge.readWav(path)
+                error = alignmentError(samples[:, 0], device.reference(track, pattern, len(samples)), stem_rate)
+                if error is not None:
+                    errors.append(abs(error))
+        takes = [take for take in engine.stats.takes if not take['label'].startswith('probe') and not take['aborted']]
+
+    return {'mode': mode, 'rate': rate, 'finished': finished, 'takes': len(takes),
+            'wall_s': round(wall, 3),
+            'takes_per_min': round(len(takes) / wall * 60, 2),
+            'cpu_percent': round(cpu / wall * 100, 1),
+            'peak_mem_mb': round(peak / 1e6, 2),
+            'stems_aligned': len(errors),
+            'align_mean_ms': round(float(np.mean(errors)) * 1000, 3) if errors else None,
+            'align_max_ms': round(float(np.max(errors)) * 1000, 3) if errors else None,
+            'xruns': sum(take['xruns'] for take in takes),
+            'reconnects': engine.stats.counters['reconnects'],
+            'checks_failed': sum(1 for check in engine.stats.checks if check['problems']),
+            'verify_failed': engine.stats.counters['verify_failed']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='underbridge_sim', description="Benchmark the export pipeline "
+                                     "against a simulated OP-Z, no hardware needed")
+    parser.add_argument('--modes', default="pattern,project", help="pattern, project and/or chain")
+    parser.add_argument('--rate', type=int, choices=(44100, 48000), default=48000)
+    parser.add_argument('--bpm', type=float, default=240.0)
+    parser.add_argument('--bars', type=int, default=1)
+    parser.add_argument('--patterns', type=int, default=2)
+    parser.add_argument('--frames-per-buffer', type=int, default=128)
+    parser.add_argument('--jitter', type=float, default=0.0, help="ADC timestamp jitter in ms")
+    parser.add_argument('--overflows', type=float, default=0.0, help="probability of a dropped block")
+    parser.add_argument('--unplug', type=float, help="disconnect the device for 2 s this many seconds into each export")
+    parser.add_argument('--verify', action='store_true', help="check the stems against a full mix take")
+    parser.add_argument('--drop-mute', type=int, metavar='TRACK',
+                        help="the device ignores the first mute of this track (1-8), it leaks into other stems")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for mode in args.modes.split(','):
+        result = benchmarkMode(mode, rate=args.rate, bpm=args.bpm, bars=args.bars, patterns=args.patterns,
+                               jitter=args.jitter / 1000, overflow_rate=args.overflows,
+                               frames_per_buffer=args.frames_per_buffer, unplug=args.unplug,
+                               verify=args.verify, drop_mute=args.drop_mute - 1 if args.drop_mute else None)
+        results.append(result)
+        print("{mode}: {takes} takes in {wall_s} s = {takes_per_min} takes/min, CPU {cpu_percent} %, "
+              "peak memory {peak_mem_mb} MB, alignment mean {align_mean_ms} ms max {align_max_ms} ms "
+              "over {stems_aligned} stems, {xruns} xruns, {reconnects} reconnects, "
+              "{checks_failed} failed checks, {verify_failed} stems still failing".format(**result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(result['finished'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())